@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Union
+
+import torch
+from torch import Tensor
+
+import comfy.model_management as model_management
+from comfy.ldm.modules.attention import attention_basic, attention_pytorch, attention_split, attention_sub_quad
+from .logger import logger
+
+
+def attention_einsum(q: Tensor, k: Tensor, v: Tensor, heads: int, mask=None):
+    # plain batched attention; with the short sequences of temporal attention (f=8..32),
+    # avoiding the head reshapes/copies of the other paths can win out
+    b, _, inner_dim = q.shape
+    dim_head = inner_dim // heads
+    q, k, v = (t.view(b, -1, heads, dim_head) for t in (q, k, v))
+    sim = torch.einsum("bihd,bjhd->bhij", q, k) * (dim_head ** -0.5)
+    if mask is not None:
+        sim = sim + mask
+    attn = sim.softmax(dim=-1, dtype=torch.float32).to(v.dtype)
+    out = torch.einsum("bhij,bjhd->bihd", attn, v)
+    return out.reshape(b, -1, inner_dim)
+
+
+ATTENTION_BACKENDS: dict[str, Callable] = {
+    "basic": attention_basic,
+    "pytorch": attention_pytorch,
+    "split": attention_split,
+    "sub_quad": attention_sub_quad,
+    "einsum": attention_einsum,
+}
+
+# human-readable table of tuned shape buckets, stored next to the models folder
+AUTOTUNE_TABLE_PATH = str(Path(__file__).parent.parent / "attention_autotune.json")
+AUTOTUNE_WARMUP_RUNS = 1
+AUTOTUNE_TIMED_RUNS = 3
+AUTOTUNE_TOLERANCE = 2e-2
+
+
+def get_batch_bucket(batch: int) -> int:
+    # next power of two, so that chunked or windowed batches share a bucket
+    return 1 << max(0, batch - 1).bit_length()
+
+
+DEVICE_NAMES: dict[torch.device, str] = {}
+
+
+def get_device_name(device: torch.device) -> str:
+    # cached, since this is part of the lookup key on every attention call
+    name = DEVICE_NAMES.get(device, None)
+    if name is None:
+        name = f"cuda:{torch.cuda.get_device_name(device)}" if device.type == "cuda" else device.type
+        DEVICE_NAMES[device] = name
+    return name
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+class AttentionAutotuner:
+    def __init__(self, table_path: str=AUTOTUNE_TABLE_PATH):
+        self.table_path = table_path
+        # key -> {"backend": name, "timings_ms": {name: ms}}
+        self.table: dict[str, dict] = None
+        # key -> callable, to avoid dict lookups by name on every call
+        self.winners: dict[str, Callable] = {}
+        # keys that could not be tuned this session (e.g. reference ran out of memory); not saved, so retried next session
+        self.failed: set[str] = set()
+        self.lock = threading.Lock()
+
+    def get_key(self, q: Tensor, k: Tensor, heads: int) -> str:
+        dim_head = q.shape[-1] // heads
+        return f"{heads}|{dim_head}|{q.shape[1]}|{k.shape[1]}|{get_batch_bucket(q.shape[0])}|{str(q.dtype)}|{get_device_name(q.device)}"
+
+    def load(self):
+        self.table = {}
+        if not os.path.isfile(self.table_path):
+            return
+        try:
+            with open(self.table_path, "r") as f:
+                self.table = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read attention autotune table at {self.table_path}, starting fresh: {e}")
+            self.table = {}
+
+    def save(self):
+        tmp_path = f"{self.table_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.table, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.table_path)
+        except OSError as e:
+            logger.warning(f"Could not write attention autotune table to {self.table_path}: {e}")
+
+    def get_attention(self, q: Tensor, k: Tensor, v: Tensor, heads: int) -> Union[Callable, None]:
+        # returns None if the shape could not be tuned, in which case the default attention should be used
+        key = self.get_key(q, k, heads)
+        attention = self.winners.get(key, None)
+        if attention is not None:
+            return attention
+        if key in self.failed:
+            return None
+        with self.lock:
+            if self.table is None:
+                self.load()
+            entry = self.table.get(key, None)
+            if entry is None or entry.get("backend", None) not in ATTENTION_BACKENDS:
+                entry = self.tune(key, q, k, v, heads)
+                if entry is None:
+                    self.failed.add(key)
+                    return None
+                self.table[key] = entry
+                self.save()
+            attention = ATTENTION_BACKENDS[entry["backend"]]
+            self.winners[key] = attention
+        return attention
+
+    def tune(self, key: str, q: Tensor, k: Tensor, v: Tensor, heads: int) -> Union[dict, None]:
+        with torch.no_grad():
+            # without a reference, candidates cannot be checked, so the shape is left untuned
+            try:
+                reference = attention_basic(q, k, v, heads).float()
+            except model_management.OOM_EXCEPTION:
+                logger.warning(f"Attention autotune: reference attention ran out of memory for [{key}], using default attention.")
+                model_management.soft_empty_cache()
+                return None
+            except Exception as e:
+                logger.warning(f"Attention autotune: reference attention failed for [{key}], using default attention: {e}")
+                return None
+            timings = {}
+            for name, attention in ATTENTION_BACKENDS.items():
+                try:
+                    out = attention(q, k, v, heads)
+                    # only consider backends that agree with the reference implementation
+                    if not torch.allclose(out.float(), reference, atol=AUTOTUNE_TOLERANCE, rtol=AUTOTUNE_TOLERANCE):
+                        logger.debug(f"Attention autotune: {name} does not match reference for {key}, skipping.")
+                        continue
+                    del out
+                    for _ in range(AUTOTUNE_WARMUP_RUNS):
+                        attention(q, k, v, heads)
+                    synchronize(q.device)
+                    start = time.perf_counter()
+                    for _ in range(AUTOTUNE_TIMED_RUNS):
+                        attention(q, k, v, heads)
+                    synchronize(q.device)
+                    timings[name] = (time.perf_counter() - start) * 1000 / AUTOTUNE_TIMED_RUNS
+                except model_management.OOM_EXCEPTION:
+                    logger.debug(f"Attention autotune: {name} ran out of memory for {key}, skipping.")
+                    model_management.soft_empty_cache()
+                except Exception as e:
+                    logger.debug(f"Attention autotune: {name} failed for {key}, skipping: {e}")
+            del reference
+        # all candidates can still run out of memory while being timed; leave the shape untuned then
+        if len(timings) == 0:
+            logger.warning(f"Attention autotune: no attention could be timed for [{key}], using default attention.")
+            return None
+        backend = min(timings, key=timings.get)
+        logger.info(f"Attention autotune: using '{backend}' for [{key}] " +
+                    ", ".join(f"{name}={ms:.3f}ms" for name, ms in sorted(timings.items(), key=lambda x: x[1])))
+        return {"backend": backend, "timings_ms": timings}
+
+    def get_table(self) -> dict[str, dict]:
+        with self.lock:
+            if self.table is None:
+                self.load()
+            return dict(self.table)
+
+    def clear(self):
+        with self.lock:
+            self.table = {}
+            self.winners.clear()
+            self.failed.clear()
+            self.save()
+
+
+attention_autotuner = AttentionAutotuner()
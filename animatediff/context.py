@@ -2,6 +2,7 @@
 from typing import Callable, Optional
 
 import numpy as np
+import torch
 
 
 class ContextType:
@@ -18,12 +19,15 @@ class ContextOptions:
 class UniformContextOptions(ContextOptions):
     CONTEXT_TYPE = ContextType.UNIFORM_WINDOW
 
-    def __init__(self, context_length: int, context_stride: int, context_overlap: int, context_schedule: int, closed_loop: bool):
+    def __init__(self, context_length: int, context_stride: int, context_overlap: int, context_schedule: int, closed_loop: bool,
+                 batch_windows: bool=False, min_coverage: int=1):
         self.context_length = context_length
         self.context_stride = context_stride
         self.context_overlap = context_overlap
         self.context_schedule = context_schedule
         self.closed_loop = closed_loop
+        self.batch_windows = batch_windows
+        self.min_coverage = min_coverage
         self.sync_context_to_pe = False
     
     def set_sync_context_to_pe(self, sync_context_to_pe: bool):
@@ -34,26 +38,47 @@ class ContextSchedules:
     UNIFORM = "uniform"
     UNIFORM_CONSTANT = "uniform_constant"
     UNIFORM_V2 = "uniform v2"
+    UNIFORM_COVERAGE = "uniform coverage"
 
-    CONTEXT_SCHEDULE_LIST = [UNIFORM] # only include somewhat functional contexts here
+    CONTEXT_SCHEDULE_LIST = [UNIFORM, UNIFORM_COVERAGE] # only include somewhat functional contexts here
+
+
+# 8-bit reversal table, used to reverse 64-bit values one byte at a time
+BIT_REVERSE_TABLE = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+BIT_REVERSE_TABLE_NP = np.frombuffer(BIT_REVERSE_TABLE, dtype=np.uint8).astype(np.uint64)
+# ordered_halving values precomputed by context plans
+ORDERED_HALVING_CACHE: dict[int, float] = {}
 
 
 # Returns fraction that has denominator that is a power of 2
 def ordered_halving(val, print_final=False):
-    # get binary value, padded with 0s for 64 bits
-    bin_str = f"{val:064b}"
-    # flip binary value, padding included
-    bin_flip = bin_str[::-1]
-    # convert binary to int
-    as_int = int(bin_flip, 2)
-    # divide by 1 << 64, equivalent to 2**64, or 18446744073709551616,
-    # or b10000000000000000000000000000000000000000000000000000000000000000 (1 with 64 zero's)
-    final = as_int / (1 << 64)
+    final = ORDERED_HALVING_CACHE.get(val, None)
+    if final is None:
+        # reverse bits of value, treated as a 64-bit int: reverse byte order, then bits within each byte
+        as_int = int.from_bytes(int(val).to_bytes(8, "little").translate(BIT_REVERSE_TABLE), "big")
+        # divide by 1 << 64, equivalent to 2**64, or 18446744073709551616,
+        # or b10000000000000000000000000000000000000000000000000000000000000000 (1 with 64 zero's)
+        final = as_int / (1 << 64)
     if print_final:
         print(f"$$$$ final: {final}")
     return final
 
 
+# Vectorized ordered_halving for an array of values; returns identical results
+def ordered_halving_array(vals) -> np.ndarray:
+    vals = np.asarray(vals, dtype=np.uint64)
+    as_int = np.zeros_like(vals)
+    for i in range(8):
+        as_int |= BIT_REVERSE_TABLE_NP[(vals >> np.uint64(8*i)) & np.uint64(0xFF)] << np.uint64(8*(7-i))
+    return as_int.astype(np.float64) / float(1 << 64)
+
+
+def precompute_ordered_halving(num_steps: int):
+    missing = [step for step in range(num_steps) if step not in ORDERED_HALVING_CACHE]
+    if len(missing) > 0:
+        ORDERED_HALVING_CACHE.update(zip(missing, ordered_halving_array(missing).tolist()))
+
+
 # Generator that returns lists of latent indeces to diffuse on
 def uniform(
     step: int = ...,
@@ -168,13 +193,42 @@ def uniform_constant(
             yield to_yield
 
 
+# Same windows as uniform, but skips windows whose frames have all already reached min_coverage in this step
+def uniform_coverage(
+    step: int = ...,
+    num_steps: Optional[int] = None,
+    num_frames: int = ...,
+    context_size: Optional[int] = None,
+    context_stride: int = 3,
+    context_overlap: int = 4,
+    closed_loop: bool = True,
+    print_final: bool = False,
+    min_coverage: int = 1,
+):
+    if num_frames <= context_size:
+        yield list(range(num_frames))
+        return
+
+    coverage = np.zeros(num_frames, dtype=np.int64)
+    for window in uniform(step, num_steps, num_frames, context_size, context_stride, context_overlap, closed_loop, print_final):
+        # window adds no coverage that is still needed, so a UNet pass on it would be redundant
+        if np.all(coverage[window] >= min_coverage):
+            continue
+        np.add.at(coverage, window, 1)
+        yield window
+
+
 # This needs to stay here below the context functions
 UNIFORM_CONTEXT_MAPPING = {
     ContextSchedules.UNIFORM: uniform,
     ContextSchedules.UNIFORM_CONSTANT: uniform_constant,
     ContextSchedules.UNIFORM_V2: uniform_v2,
+    ContextSchedules.UNIFORM_COVERAGE: uniform_coverage,
 }
 
+# context functions that accept a min_coverage target
+COVERAGE_CONTEXT_SCHEDULES = [ContextSchedules.UNIFORM_COVERAGE]
+
 
 # TODO: expand to support other context window types (future feature)
 def get_context_scheduler(name: str) -> Callable:
@@ -184,6 +238,98 @@ def get_context_scheduler(name: str) -> Callable:
     return context_func
 
 
+class ContextWindow:
+    def __init__(self, idxs: list[int]):
+        self.idxs = np.array(idxs, dtype=np.int64)
+        self.key = tuple(self.idxs.tolist())
+        # contiguous, non-wrapping windows can be represented as a slice, allowing views instead of gathers
+        self.slice: Optional[slice] = None
+        if len(self.idxs) > 0 and np.all(np.diff(self.idxs) == 1):
+            self.slice = slice(int(self.idxs[0]), int(self.idxs[-1]) + 1, 1)
+        self.full_idxs: dict[tuple[int, int], list[int]] = {}
+        self.full_idxs_tensors: dict[tuple, torch.Tensor] = {}
+
+    def __len__(self):
+        return len(self.idxs)
+
+    def is_slice(self) -> bool:
+        return self.slice is not None
+
+    def get_full_idxs(self, axes_factor: int, video_length: int) -> list[int]:
+        # account for all portions of input frames
+        key = (axes_factor, video_length)
+        full_idxs = self.full_idxs.get(key, None)
+        if full_idxs is None:
+            full_idxs = (np.arange(axes_factor)[:, None] * video_length + self.idxs[None, :]).reshape(-1).tolist()
+            self.full_idxs[key] = full_idxs
+        return full_idxs
+
+    def get_full_idxs_tensor(self, axes_factor: int, video_length: int, device: torch.device) -> torch.Tensor:
+        key = (axes_factor, video_length, device)
+        full_idxs = self.full_idxs_tensors.get(key, None)
+        if full_idxs is None:
+            full_idxs = torch.tensor(self.get_full_idxs(axes_factor, video_length), dtype=torch.long, device=device)
+            self.full_idxs_tensors[key] = full_idxs
+        return full_idxs
+
+
+class ContextPlan:
+    def __init__(self, context_schedule: str, num_steps: Optional[int], num_frames: int, context_length: int,
+                 context_stride: int, context_overlap: int, closed_loop: bool, min_coverage: int=1):
+        self.context_schedule = context_schedule
+        self.num_steps = num_steps
+        self.num_frames = num_frames
+        self.context_length = context_length
+        self.context_stride = context_stride
+        self.context_overlap = context_overlap
+        self.closed_loop = closed_loop
+        self.min_coverage = min_coverage
+        self.scheduler = get_context_scheduler(context_schedule)
+        self.scheduler_kwargs = {}
+        if context_schedule in COVERAGE_CONTEXT_SCHEDULES:
+            self.scheduler_kwargs["min_coverage"] = min_coverage
+        # windows per step, stored as compact int arrays (with slices when contiguous)
+        self.windows: dict[int, list[ContextWindow]] = {}
+        # generate all windows up front when the step count is known
+        if num_steps:
+            precompute_ordered_halving(num_steps)
+            for step in range(num_steps):
+                self.get_windows(step)
+
+    def get_windows(self, step: int) -> list[ContextWindow]:
+        windows = self.windows.get(step, None)
+        if windows is None:
+            windows = [ContextWindow(ctx_idxs) for ctx_idxs in self.scheduler(
+                step, self.num_steps, self.num_frames, self.context_length,
+                self.context_stride, self.context_overlap, self.closed_loop, **self.scheduler_kwargs)]
+            self.windows[step] = windows
+        return windows
+
+    def get_total_windows(self, num_steps: int=None) -> int:
+        num_steps = num_steps or self.num_steps or 0
+        return sum(len(self.get_windows(step)) for step in range(num_steps))
+
+
+# cached context plans, reused across runs with identical settings
+context_plans: dict[tuple, ContextPlan] = {}
+MAX_CACHED_CONTEXT_PLANS = 16
+
+
+def get_context_plan(context_schedule: str, num_steps: Optional[int], num_frames: int, context_length: int,
+                     context_stride: int, context_overlap: int, closed_loop: bool, min_coverage: int=1) -> ContextPlan:
+    key = (num_frames, context_length, context_stride, context_overlap, closed_loop, context_schedule, num_steps, min_coverage)
+    plan = context_plans.get(key, None)
+    if plan is None:
+        plan = ContextPlan(context_schedule=context_schedule, num_steps=num_steps, num_frames=num_frames,
+                           context_length=context_length, context_stride=context_stride,
+                           context_overlap=context_overlap, closed_loop=closed_loop, min_coverage=min_coverage)
+        # keep cache small; drop oldest plan when full
+        if len(context_plans) >= MAX_CACHED_CONTEXT_PLANS:
+            context_plans.pop(next(iter(context_plans)))
+        context_plans[key] = plan
+    return plan
+
+
 def get_total_steps(
     scheduler,
     timesteps: list[int],
@@ -195,16 +341,14 @@ def get_total_steps(
     closed_loop: bool = True,
 ):
     return sum(
-        len(
-            list(
-                scheduler(
-                    i,
-                    num_steps,
-                    num_frames,
-                    context_size,
-                    context_stride,
-                    context_overlap,
-                )
+        sum(
+            1 for _ in scheduler(
+                i,
+                num_steps,
+                num_frames,
+                context_size,
+                context_stride,
+                context_overlap,
             )
         )
         for i in range(len(timesteps))
@@ -226,3 +370,125 @@ def get_total_steps_fixed(
         for context in scheduler(i, num_steps, num_frames, context_size, context_stride, context_overlap, closed_loop=closed_loop):
             total_loops += 1
     return total_loops
+
+
+class ContextScheduleReport:
+    # rough per-frame estimates used to predict memory use; SD1.5-sized UNet, 8 temporal attention heads
+    LATENT_CHANNELS = 4
+    LATENT_STATE_COPIES = 6 # sampler x/denoised/noise/etc. + sliding cond/uncond accumulators
+    FIRST_LEVEL_CHANNELS = 320
+    FIRST_LEVEL_LIVE_TENSORS = 12
+    TEMPORAL_ATTENTION_HEADS = 8
+
+    def __init__(self, video_length: int, num_steps: int, windows_per_step: list[int], invocations_per_step: list[int],
+                 max_windows_per_invocation: int, coverage: np.ndarray, latent_bytes: int, activation_bytes: int):
+        self.video_length = video_length
+        self.num_steps = num_steps
+        self.windows_per_step = windows_per_step
+        self.total_windows = sum(windows_per_step)
+        # with batch_windows, several windows are run per UNet invocation
+        self.invocations_per_step = invocations_per_step
+        self.total_invocations = sum(invocations_per_step)
+        self.max_windows_per_invocation = max_windows_per_invocation
+        self.coverage = coverage
+        # histogram of how many frames were diffused N times over the whole run
+        values, counts = np.unique(coverage, return_counts=True)
+        self.coverage_histogram: dict[int, int] = {int(v): int(c) for v, c in zip(values, counts)}
+        self.latent_bytes = latent_bytes
+        self.activation_bytes = activation_bytes
+
+    def to_string(self) -> str:
+        mib = 1024 * 1024
+        windows_min = min(self.windows_per_step) if self.windows_per_step else 0
+        windows_max = max(self.windows_per_step) if self.windows_per_step else 0
+        lines = [
+            f"frames: {self.video_length}, steps: {self.num_steps}",
+            f"total UNet invocations (cond+uncond batched): {self.total_invocations}",
+            f"total context windows: {self.total_windows}, max windows per invocation: {self.max_windows_per_invocation}",
+            f"windows per step: min {windows_min}, max {windows_max}, avg {self.total_windows / max(1, self.num_steps):.2f}",
+            f"per-frame coverage over run (passes: frames): {self.coverage_histogram}",
+            f"estimated latent state memory: {self.latent_bytes / mib:.1f} MiB",
+            f"estimated peak activation memory per invocation: {self.activation_bytes / mib:.1f} MiB",
+        ]
+        return "\n".join(lines)
+
+
+# cap on context windows stacked into one model call when batch_windows is on, regardless of the reported batch area
+MAX_WINDOWS_PER_BATCH = 8
+
+
+def get_windows_per_batch(max_batch_area: Optional[int], window_area: int) -> int:
+    # without a known budget, windows are run one at a time like without batch_windows
+    if max_batch_area is None or max_batch_area <= 0:
+        return 1
+    return max(1, min(MAX_WINDOWS_PER_BATCH, max_batch_area // window_area))
+
+
+def count_window_groups(window_lengths: list[int], windows_per_batch: int) -> tuple[int, int]:
+    # mirrors window grouping of sliding sampling: consecutive windows of the same length are stacked, up to windows_per_batch;
+    # returns (amount of groups, largest group size)
+    groups = 0
+    largest = 0
+    current_size = 0
+    current_length = None
+    for length in window_lengths:
+        if current_size > 0 and current_size < windows_per_batch and length == current_length:
+            current_size += 1
+        else:
+            groups += 1
+            current_size = 1
+            current_length = length
+        largest = max(largest, current_size)
+    return groups, largest
+
+
+def simulate_context_schedule(video_length: int, num_steps: int, context_options: UniformContextOptions=None,
+                              width: int=512, height: int=512, cond_count: int=2, dtype_size: int=2,
+                              max_batch_area: int=None) -> ContextScheduleReport:
+    # CPU-only prediction of how much work a sampling run with these context options will do.
+    # Windows are streamed from the scheduler and only counted, instead of building (and caching) a ContextPlan,
+    # so that long videos with many steps do not keep every window in memory.
+    # max_batch_area is the sampling device's maximum batch area, used to group windows when batch_windows is on;
+    # None means unknown, so one window per invocation
+    windows_per_step = []
+    invocations_per_step = []
+    max_windows_per_invocation = 1
+    coverage = np.zeros(video_length, dtype=np.int64)
+    latent_h, latent_w = height // 8, width // 8
+    if context_options is None or video_length <= context_options.context_length:
+        frames_per_window = video_length
+        windows_per_step = [1] * num_steps
+        invocations_per_step = [1] * num_steps
+        coverage += num_steps
+    else:
+        frames_per_window = context_options.context_length
+        scheduler = get_context_scheduler(context_options.context_schedule)
+        scheduler_kwargs = {}
+        if context_options.context_schedule in COVERAGE_CONTEXT_SCHEDULES:
+            scheduler_kwargs["min_coverage"] = getattr(context_options, "min_coverage", 1)
+        windows_per_batch = 1
+        if getattr(context_options, "batch_windows", False) and not getattr(context_options, "sync_context_to_pe", False):
+            window_area = frames_per_window * latent_h * latent_w * max(1, cond_count)
+            windows_per_batch = get_windows_per_batch(max_batch_area, window_area)
+        precompute_ordered_halving(num_steps)
+        for step in range(num_steps):
+            window_lengths = []
+            for ctx_idxs in scheduler(step, num_steps, video_length, context_options.context_length, context_options.context_stride,
+                                      context_options.context_overlap, context_options.closed_loop, **scheduler_kwargs):
+                np.add.at(coverage, ctx_idxs, 1)
+                window_lengths.append(len(ctx_idxs))
+            groups, largest = count_window_groups(window_lengths, windows_per_batch)
+            windows_per_step.append(len(window_lengths))
+            invocations_per_step.append(groups)
+            max_windows_per_invocation = max(max_windows_per_invocation, largest)
+    # sampler latents are kept in fp32
+    latent_bytes = ContextScheduleReport.LATENT_STATE_COPIES * video_length * ContextScheduleReport.LATENT_CHANNELS * latent_h * latent_w * 4
+    # first UNet level dominates: feature maps plus temporal attention scores of shape (b*h*w*heads, f, f);
+    # batched windows multiply both by the amount of windows per invocation
+    batch = frames_per_window * cond_count * max_windows_per_invocation
+    feature_bytes = ContextScheduleReport.FIRST_LEVEL_LIVE_TENSORS * batch * ContextScheduleReport.FIRST_LEVEL_CHANNELS * latent_h * latent_w * dtype_size
+    temporal_attn_bytes = cond_count * max_windows_per_invocation * latent_h * latent_w * ContextScheduleReport.TEMPORAL_ATTENTION_HEADS \
+        * frames_per_window * frames_per_window * dtype_size
+    return ContextScheduleReport(video_length=video_length, num_steps=num_steps, windows_per_step=windows_per_step,
+                                 invocations_per_step=invocations_per_step, max_windows_per_invocation=max_windows_per_invocation,
+                                 coverage=coverage, latent_bytes=latent_bytes, activation_bytes=feature_bytes + temporal_attn_bytes)
@@ -0,0 +1,165 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Union
+
+from torch import Tensor, nn
+
+from .logger import logger
+
+
+class EvictionPolicy:
+    LRU = "lru"
+    LFU = "lfu"
+
+    LIST = [LRU, LFU]
+
+
+def get_env_mb(name: str) -> int:
+    # budgets are given in MB; unset, invalid, or 0 means unlimited
+    try:
+        return max(0, int(os.environ.get(name, "0")))
+    except ValueError:
+        logger.warning(f"Invalid value for {name}, expected an amount of MB; ignoring it.")
+        return 0
+
+
+def get_tensors(obj: Any) -> list[Tensor]:
+    if isinstance(obj, nn.Module):
+        return list(obj.parameters()) + list(obj.buffers())
+    get_obj_tensors = getattr(obj, "get_tensors", None)
+    if callable(get_obj_tensors):
+        return get_obj_tensors()
+    state_dict = getattr(obj, "state_dict", None)
+    if isinstance(state_dict, dict):
+        return [t for t in state_dict.values() if isinstance(t, Tensor)]
+    return []
+
+
+def get_memory_usage(obj: Any) -> tuple[int, int]:
+    # returns (RAM bytes, VRAM bytes) used by tensors of obj
+    ram = 0
+    vram = 0
+    for t in get_tensors(obj):
+        size = t.numel() * t.element_size()
+        if t.device.type == "cpu":
+            ram += size
+        else:
+            vram += size
+    return ram, vram
+
+
+class ModelCache:
+    # cache of loaded models with RAM/VRAM budgets; entries that are pinned (in use) are never evicted.
+    # Budgets and policy are read from env vars ADE_{name}_CACHE_RAM_MB, ADE_{name}_CACHE_VRAM_MB, and ADE_{name}_CACHE_POLICY
+    def __init__(self, name: str):
+        self.name = name
+        env_prefix = f"ADE_{name.upper()}_CACHE"
+        self.ram_budget = get_env_mb(f"{env_prefix}_RAM_MB") * 1024 * 1024
+        self.vram_budget = get_env_mb(f"{env_prefix}_VRAM_MB") * 1024 * 1024
+        self.policy = os.environ.get(f"{env_prefix}_POLICY", EvictionPolicy.LRU).lower()
+        if self.policy not in EvictionPolicy.LIST:
+            logger.warning(f"Unknown {env_prefix}_POLICY '{self.policy}', using '{EvictionPolicy.LRU}'.")
+            self.policy = EvictionPolicy.LRU
+        # ordered from least to most recently used
+        self.entries: OrderedDict[str, Any] = OrderedDict()
+        self.use_counts: dict[str, int] = {}
+        self.pins: dict[str, int] = {}
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> Union[Any, None]:
+        with self.lock:
+            value = self.entries.get(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            self.use_counts[key] += 1
+            return value
+
+    def put(self, key: str, value: Any):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.use_counts[key] = self.use_counts.get(key, 0) + 1
+            self.evict(keep_key=key)
+
+    def pop(self, key: str, default: Any=None) -> Union[Any, None]:
+        with self.lock:
+            self.use_counts.pop(key, None)
+            return self.entries.pop(key, default)
+
+    def pin(self, key: str):
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, key: str):
+        with self.lock:
+            count = self.pins.get(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+            else:
+                self.pins.pop(key, None)
+            # entries may have been kept over budget while pinned
+            self.evict()
+
+    def is_pinned(self, key: str) -> bool:
+        return self.pins.get(key, 0) > 0
+
+    def has_budget(self) -> bool:
+        return self.ram_budget > 0 or self.vram_budget > 0
+
+    def get_usage(self) -> tuple[int, int]:
+        ram = 0
+        vram = 0
+        for value in self.entries.values():
+            entry_ram, entry_vram = get_memory_usage(value)
+            ram += entry_ram
+            vram += entry_vram
+        return ram, vram
+
+    def is_over_budget(self, ram: int, vram: int) -> bool:
+        return (self.ram_budget > 0 and ram > self.ram_budget) or (self.vram_budget > 0 and vram > self.vram_budget)
+
+    def get_eviction_candidates(self, keep_key: str=None) -> list[str]:
+        keys = [key for key in self.entries.keys() if key != keep_key and not self.is_pinned(key)]
+        if self.policy == EvictionPolicy.LFU:
+            # stable sort, so ties are broken by least recent use
+            keys.sort(key=lambda key: self.use_counts.get(key, 0))
+        return keys
+
+    def evict(self, keep_key: str=None):
+        with self.lock:
+            if not self.has_budget():
+                return
+            ram, vram = self.get_usage()
+            if not self.is_over_budget(ram, vram):
+                return
+            for key in self.get_eviction_candidates(keep_key):
+                entry_ram, entry_vram = get_memory_usage(self.entries[key])
+                self.pop(key)
+                self.evictions += 1
+                ram -= entry_ram
+                vram -= entry_vram
+                logger.info(f"Evicted {self.name} {key} from cache ({entry_ram / 2**20:.1f}MB RAM, {entry_vram / 2**20:.1f}MB VRAM) " +
+                            f"to stay within budget; {self.get_stats_string()}")
+                if not self.is_over_budget(ram, vram):
+                    return
+            logger.warning(f"{self.name} cache is over budget ({ram / 2**20:.1f}MB RAM, {vram / 2**20:.1f}MB VRAM), " +
+                           "but remaining entries are in use.")
+
+    def get_stats(self) -> dict[str, int]:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def get_stats_string(self) -> str:
+        return ", ".join(f"{name}: {value}" for name, value in self.get_stats().items())
@@ -1,14 +1,22 @@
 import hashlib
+import inspect
+import json
+import mmap
 import os
+import struct
+import threading
 from pathlib import Path
 from typing import Callable
 
 import numpy as np
+import torch
+from torch import Tensor, nn
 
 import folder_paths
 from comfy.model_base import SDXL, BaseModel, model_sampling
 from comfy.model_management import xformers_enabled
 from comfy.model_patcher import ModelPatcher
+from .logger import logger
 
 
 class IsChangedHelper:
@@ -125,19 +133,124 @@ def get_motion_lora_path(lora_name: str):
 
 # modified from https://stackoverflow.com/questions/22058048/hashing-a-file-in-python
 def calculate_file_hash(filename: str, hash_every_n: int = 50):
+    chunk_size = 1024*1024
     h = hashlib.sha256()
-    b = bytearray(1024*1024)
+    b = bytearray(chunk_size)
     mv = memoryview(b)
     with open(filename, 'rb', buffering=0) as f:
         i = 0
-        # don't hash entire file, only portions of it
+        # don't hash entire file, only every nth chunk of it - seek past the rest instead of reading them
         while n := f.readinto(mv):
-            if i%hash_every_n == 0:
-                h.update(mv[:n])
-            i += 1
+            h.update(mv[:n])
+            i += hash_every_n
+            f.seek(i * chunk_size)
     return h.hexdigest()
 
 
+class FileHashIndex:
+    # persistent index of file hashes, so that unchanged files do not need to be read again to get their hash;
+    # entries are invalidated when a file's size, mtime, or inode change
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.entries: dict[str, dict] = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.entries = {}
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read file hash index at {self.index_path}, starting fresh: {e}")
+            self.entries = {}
+
+    def save(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not write file hash index to {self.index_path}: {e}")
+
+    def get_file_hash(self, filename: str, hash_every_n: int = 50) -> str:
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        key = f"{filename}|{hash_every_n}"
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            entry = self.entries.get(key, None)
+            if entry is not None and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns \
+                    and entry.get("inode") == stat.st_ino:
+                return entry["hash"]
+        # calculate outside of lock, so other files can be looked up in the meantime
+        file_hash = calculate_file_hash(filename, hash_every_n=hash_every_n)
+        with self.lock:
+            self.entries[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino, "hash": file_hash}
+            self.save()
+        return file_hash
+
+
+# stored next to the models folder
+file_hash_index = FileHashIndex(str(Path(__file__).parent.parent / "file_hash_index.json"))
+
+
+def get_file_hash(filename: str, hash_every_n: int = 50) -> str:
+    return file_hash_index.get_file_hash(filename, hash_every_n=hash_every_n)
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def is_mmap_load_supported(filename: str) -> bool:
+    # mapped tensors are assigned directly into modules, which requires load_state_dict(assign=True) (torch 2.1+)
+    return filename.lower().endswith(".safetensors") and "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def load_safetensors_mmap(filename: str) -> dict[str, Tensor]:
+    # tensors are views into a copy-on-write mapping of the file, so nothing is read until used,
+    # and only tensors modified in place end up with private copies of their pages
+    with open(filename, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header: dict = json.loads(f.read(header_len))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_len
+    state_dict = {}
+    for key, info in header.items():
+        if key == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"], None)
+        if dtype is None:
+            raise ValueError(f"Unsupported safetensors dtype {info['dtype']} for {key}.")
+        start, end = info["data_offsets"]
+        if start == end:
+            state_dict[key] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        element_size = torch.empty((), dtype=dtype).element_size()
+        offset = data_start + start
+        if offset % element_size != 0:
+            # misaligned tensors cannot be viewed directly, so copy them out
+            tensor = torch.frombuffer(bytearray(mapped[offset:data_start + end]), dtype=dtype)
+        else:
+            tensor = torch.frombuffer(mapped, dtype=dtype, count=(end - start) // element_size, offset=offset)
+        state_dict[key] = tensor.reshape(info["shape"])
+    return state_dict
+
+
 def calculate_model_hash(model: ModelPatcher):
     unet = model.model.diff
     t = unet.input_blocks[1]
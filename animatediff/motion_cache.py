@@ -0,0 +1,191 @@
+import math
+from typing import Union
+
+import torch
+from torch import Tensor, nn
+
+from .logger import logger
+
+
+# key under transformer_options that carries the MotionCacheCall of the current model call to temporal modules
+MOTION_CACHE_KEY = "ad_motion_cache_key"
+
+
+class MotionCacheOptions:
+    def __init__(self, refresh_steps: int=1, sigma_threshold: float=0.0, cache_depths: str="", memory_budget_mb: float=2048.0):
+        # residuals are reused for this many steps after being computed
+        self.refresh_steps = refresh_steps
+        # when above 0, residuals are only reused once sigma drops below this value
+        self.sigma_threshold = sigma_threshold
+        # comma-separated block depths to cache, e.g. "down,mid" or "down0,up3"; empty means all
+        self.cache_depths = cache_depths
+        self.depths = set(depth.strip().lower() for depth in cache_depths.split(",") if depth.strip())
+        # when above 0, caching is turned off for the rest of the run once stored residuals would exceed this many MB
+        self.memory_budget_mb = memory_budget_mb
+
+    def get_memory_budget(self) -> Union[int, None]:
+        if self.memory_budget_mb <= 0:
+            return None
+        return int(self.memory_budget_mb * 2**20)
+
+    def is_depth_cached(self, depth: str) -> bool:
+        if len(self.depths) == 0:
+            return True
+        # depth is formatted as block type + index, like "down0"; block type alone matches all indexes
+        return depth in self.depths or depth.rstrip("0123456789") in self.depths
+
+
+class MotionCacheCall:
+    # describes which latent frames the rows of a model call belong to, so residuals can be stored per frame
+    def __init__(self, slots: list[tuple], full_length: int, frame_idxs: Union[list[int], None]=None):
+        # one slot per chunk of the batch - (cond_or_uncond, index of cond entry)
+        self.slots = slots
+        # length of the full latent batch
+        self.full_length = full_length
+        # absolute frame positions of the rows of each chunk; None means all frames in order
+        self.frame_idxs = frame_idxs if frame_idxs is not None else list(range(full_length))
+        self.idx_tensors: dict[torch.device, Tensor] = {}
+
+    def get_idx_tensor(self, device: torch.device) -> Tensor:
+        idx_tensor = self.idx_tensors.get(device, None)
+        if idx_tensor is None:
+            idx_tensor = torch.tensor(self.frame_idxs, dtype=torch.long, device=device)
+            self.idx_tensors[device] = idx_tensor
+        return idx_tensor
+
+
+class MotionCacheEntry:
+    # residuals of a single temporal module for one slot, for all frames of the latent
+    def __init__(self, residual: Tensor):
+        self.residual = residual
+        self.nbytes = residual.numel() * residual.element_size()
+        # step each frame's residual was last computed on
+        self.steps = [None] * residual.shape[0]
+
+
+class MotionCacheState:
+    def __init__(self, options: MotionCacheOptions, offload_device: torch.device=None):
+        self.options = options
+        # with sliding context, residuals of all frames do not fit alongside activations on the compute device,
+        # so they are stored here and only the frames of the current window(s) get moved over
+        self.offload_device = offload_device
+        # (motion_cache_id, slot) -> entry
+        self.entries: dict[tuple, MotionCacheEntry] = {}
+        self.total_bytes = 0
+        self.peak_bytes = 0
+        # set once the memory budget is exceeded; layers then always run
+        self.disabled = False
+        self.current_step: int = None
+        # step on which residuals were last refreshed; residuals are only reused on steps in between refreshes
+        self.refresh_step: int = None
+        self.reuse_allowed = False
+        self.sigma: Union[float, None] = None
+        self.hits = 0
+        self.misses = 0
+
+    def begin_sampling_call(self, step: int, timestep: Tensor):
+        # samplers may call the model more than once per step; reuse is decided once per step
+        if step == self.current_step:
+            return
+        self.current_step = step
+        # only read sigma when needed, since it requires a sync with the device
+        if self.options.sigma_threshold > 0:
+            self.sigma = float(timestep[0])
+        sigma_allowed = self.options.sigma_threshold <= 0 or self.sigma < self.options.sigma_threshold
+        if not sigma_allowed or self.refresh_step is None or step - self.refresh_step > self.options.refresh_steps:
+            self.refresh_step = step
+        self.reuse_allowed = sigma_allowed and step != self.refresh_step
+        self.drop_stale_entries()
+
+    def drop_stale_entries(self):
+        # entries with no frame young enough to be reused can never hit again, so free their memory
+        for key in list(self.entries.keys()):
+            steps = [s for s in self.entries[key].steps if s is not None]
+            if len(steps) == 0 or self.current_step - max(steps) > self.options.refresh_steps:
+                self.total_bytes -= self.entries.pop(key).nbytes
+
+    def is_fresh(self, entry: MotionCacheEntry, frame_idxs: list[int]) -> bool:
+        for idx in frame_idxs:
+            computed_step = entry.steps[idx]
+            # residuals computed earlier this step (e.g. by an overlapping context window) count as fresh
+            if computed_step is None or self.current_step - computed_step > self.options.refresh_steps:
+                return False
+        return True
+
+    def get_storage_device(self, call: MotionCacheCall, chunk: Tensor) -> torch.device:
+        # when the call covers the whole latent (no sliding context), residuals are no bigger than the activations
+        if self.offload_device is None or len(call.frame_idxs) == call.full_length:
+            return chunk.device
+        return self.offload_device
+
+    def matches(self, entry: Union[MotionCacheEntry, None], call: MotionCacheCall, chunk: Tensor) -> bool:
+        return entry is not None and entry.residual.shape[0] == call.full_length and entry.residual.shape[1:] == chunk.shape[1:] \
+            and entry.residual.dtype == chunk.dtype and entry.residual.device == self.get_storage_device(call, chunk)
+
+    def get_entries(self, layer: nn.Module, call: MotionCacheCall, chunk: Tensor) -> Union[list[MotionCacheEntry], None]:
+        entries = []
+        for slot in call.slots:
+            key = (layer.motion_cache_id, slot)
+            entry = self.entries.get(key, None)
+            if not self.matches(entry, call, chunk):
+                if entry is not None:
+                    self.total_bytes -= self.entries.pop(key).nbytes
+                storage_device = self.get_storage_device(call, chunk)
+                shape = (call.full_length,) + tuple(chunk.shape[1:])
+                budget = self.options.get_memory_budget()
+                if budget is not None and self.total_bytes + math.prod(shape) * chunk.element_size() > budget:
+                    self.disable(budget)
+                    return None
+                pin_memory = storage_device.type == "cpu" and chunk.device.type == "cuda"
+                entry = MotionCacheEntry(torch.zeros(shape, dtype=chunk.dtype, device=storage_device, pin_memory=pin_memory))
+                self.entries[key] = entry
+                self.total_bytes += entry.nbytes
+                self.peak_bytes = max(self.peak_bytes, self.total_bytes)
+            entries.append(entry)
+        return entries
+
+    def disable(self, budget: int):
+        logger.warning(f"Motion cache: stored outputs would exceed memory_budget_mb ({budget / 2**20:.0f}MB), " +
+                       "so caching is turned off for the rest of this run. Raise memory_budget_mb or narrow cache_depths to keep it on.")
+        self.disabled = True
+        self.clear()
+
+    def forward(self, layer: nn.Module, x: Tensor, context: Tensor, call: Union[MotionCacheCall, None]) -> Tensor:
+        if self.disabled or call is None or x.shape[0] != len(call.slots) * len(call.frame_idxs):
+            return layer(x, context)
+        key_chunks = x.chunk(len(call.slots))
+        storage_device = self.get_storage_device(call, key_chunks[0])
+        if self.reuse_allowed:
+            entries = [self.entries.get((layer.motion_cache_id, slot), None) for slot in call.slots]
+            if all(self.matches(entry, call, key_chunks[0]) and self.is_fresh(entry, call.frame_idxs) for entry in entries):
+                self.hits += 1
+                idx_tensor = call.get_idx_tensor(storage_device)
+                # only the frames of the current window(s) are moved to the compute device
+                residual = torch.cat([entry.residual.index_select(0, idx_tensor) for entry in entries]).to(x.device, non_blocking=True)
+                return x + residual
+        self.misses += 1
+        out = layer(x, context)
+        entries = self.get_entries(layer, call, key_chunks[0])
+        if entries is None:
+            return out
+        # scatter residuals into per-frame buffers, so that windows covering the same frames on later steps can reuse them;
+        # if windows batched together overlap, either window's residual may end up stored for shared frames
+        idx_tensor = call.get_idx_tensor(storage_device)
+        residual_chunks = (out - x).to(storage_device).chunk(len(call.slots))
+        for entry, residual_chunk in zip(entries, residual_chunks):
+            entry.residual.index_copy_(0, idx_tensor, residual_chunk)
+            for idx in call.frame_idxs:
+                entry.steps[idx] = self.current_step
+        return out
+
+    def get_hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def log_hit_rate(self):
+        logger.info(f"Motion cache: reused {self.hits} of {self.hits + self.misses} temporal module calls ({self.get_hit_rate():.1%}), " +
+                    f"peak of stored outputs {self.peak_bytes / 2**20:.0f}MB.")
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
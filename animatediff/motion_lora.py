@@ -1,3 +1,4 @@
+import torch
 from torch import Tensor
 
 
@@ -14,14 +15,73 @@ class MotionLoRAInfo:
         return MotionLoRAInfo(self.name, self.strength, self.hash)
 
 
+# adapted from https://github.com/guoyww/AnimateDiff/blob/main/animatediff/utils/convert_lora_safetensor_to_diffusers.py
+# Example LoRA keys:
+# down_blocks.0.motion_modules.0.temporal_transformer.transformer_blocks.0.attention_blocks.0.processor.to_q_lora.down.weight
+# down_blocks.0.motion_modules.0.temporal_transformer.transformer_blocks.0.attention_blocks.0.processor.to_q_lora.up.weight
+#
+# Example model keys: 
+# down_blocks.0.motion_modules.0.temporal_transformer.transformer_blocks.0.attention_blocks.0.to_q.weight
+#
+def get_lora_key_map(state_dict: dict[str, Tensor]) -> dict[str, tuple[str, str]]:
+    # TODO: generalize for both AD and HSXL
+    # returns model key -> (down key, up key)
+    key_map = {}
+    for key in state_dict:
+        # only process lora down key (we will process up at the same time as down)
+        if "up." in key: continue
+        # key to get up value
+        up_key = key.replace(".down.", ".up.")
+        # adapt key to match model_dict format - remove 'processor.', '_lora', 'down.', and 'up.'
+        model_key = key.replace("processor.", "").replace("_lora", "").replace("down.", "").replace("up.", "")
+        # model keys have a '0.' after all 'to_out.' weight keys
+        model_key = model_key.replace("to_out.", "to_out.0.")
+        key_map[model_key] = (key, up_key)
+    return key_map
+
+
 class MotionLoRAWrapper:
     def __init__(self, state_dict: dict[str, Tensor], hash: str):
         self.state_dict = state_dict
         self.hash = hash
-        self.info: MotionLoRAInfo = None
+        # key mapping only depends on the file, so it is computed once
+        self.key_map = get_lora_key_map(state_dict)
+        self.has_midblock = any(key.startswith("mid_block.") for key in state_dict)
+        # unscaled deltas (up @ down) per model key, computed on first use; strength is applied when patching
+        self.deltas: dict[str, Tensor] = None
     
-    def set_info(self, info: MotionLoRAInfo):
-        self.info = info
+    def get_deltas(self, include_midblock: bool=True) -> dict[str, Tensor]:
+        if self.deltas is None:
+            self.deltas = self.compute_deltas()
+        if include_midblock:
+            return self.deltas
+        # if motion model doesn't have a mid_block, skip mid_block entries
+        return {model_key: delta for model_key, delta in self.deltas.items() if "mid_block" not in model_key}
+
+    def compute_deltas(self) -> dict[str, Tensor]:
+        # group pairs of same shape, so that each group is merged with a single batched matmul
+        groups: dict[tuple, list[str]] = {}
+        for model_key, (down_key, up_key) in self.key_map.items():
+            weight_down = self.state_dict[down_key]
+            weight_up = self.state_dict[up_key]
+            group_key = (tuple(weight_up.shape), tuple(weight_down.shape), weight_up.dtype, weight_up.device)
+            groups.setdefault(group_key, []).append(model_key)
+        deltas = {}
+        with torch.no_grad():
+            for model_keys in groups.values():
+                ups = torch.stack([self.state_dict[self.key_map[model_key][1]] for model_key in model_keys])
+                downs = torch.stack([self.state_dict[self.key_map[model_key][0]] for model_key in model_keys])
+                for model_key, delta in zip(model_keys, torch.bmm(ups, downs).unbind(0)):
+                    deltas[model_key] = delta
+                del ups, downs
+        return deltas
+
+    def get_tensors(self) -> list[Tensor]:
+        # used by model cache for memory accounting
+        tensors = list(self.state_dict.values())
+        if self.deltas is not None:
+            tensors.extend(self.deltas.values())
+        return tensors
 
 
 class MotionLoRAList:
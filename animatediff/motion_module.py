@@ -1,3 +1,6 @@
+import struct
+from contextlib import nullcontext
+
 import torch
 import torch.nn.functional as F
 from einops import rearrange
@@ -10,9 +13,11 @@ from comfy.ldm.modules.diffusionmodules.openaimodel import ResBlock, SpatialTran
 from comfy.model_patcher import ModelPatcher
 from comfy.utils import calculate_parameters, load_torch_file
 from .logger import logger
-from .model_utils import ModelTypesSD, calculate_file_hash, get_motion_lora_path, get_motion_model_path, \
-    get_sd_model_type
-from .motion_lora import MotionLoRAList, MotionLoRAWrapper
+from .model_cache import ModelCache
+from .motion_cache import MotionCacheOptions
+from .model_utils import ModelTypesSD, get_file_hash, get_motion_lora_path, get_motion_model_path, \
+    get_sd_model_type, is_mmap_load_supported, load_safetensors_mmap
+from .motion_lora import MotionLoRAInfo, MotionLoRAList, MotionLoRAWrapper
 from .motion_module_ad import AnimDiffMotionWrapper, has_mid_block
 from .motion_module_hsxl import HotShotXLMotionWrapper, TransformerTemporal
 from .motion_utils import GenericMotionWrapper, InjectorVersion
@@ -28,62 +33,57 @@ comfy_model_patcher.ModelPatcher.clone = clone_injection
 
 
 # cached motion modules
-motion_modules: dict[str, GenericMotionWrapper] = {}
+motion_modules = ModelCache("motion_module")
 # cached motion loras
-motion_loras: dict[str, MotionLoRAWrapper] = {}
-
-
-# adapted from https://github.com/guoyww/AnimateDiff/blob/main/animatediff/utils/convert_lora_safetensor_to_diffusers.py
-# Example LoRA keys:
-# down_blocks.0.motion_modules.0.temporal_transformer.transformer_blocks.0.attention_blocks.0.processor.to_q_lora.down.weight
-# down_blocks.0.motion_modules.0.temporal_transformer.transformer_blocks.0.attention_blocks.0.processor.to_q_lora.up.weight
-#
-# Example model keys: 
-# down_blocks.0.motion_modules.0.temporal_transformer.transformer_blocks.0.attention_blocks.0.to_q.weight
-#
-def apply_lora_to_mm_state_dict(model_dict: dict[str, Tensor], lora: MotionLoRAWrapper):
-    # TODO: generalize for both AD and HSXL
-    model_has_midblock = has_mid_block(model_dict)
-    lora_has_midblock = has_mid_block(lora.state_dict)
+motion_loras = ModelCache("motion_lora")
+
+
+def apply_motion_loras(motion_module: GenericMotionWrapper, loras: list[tuple[MotionLoRAWrapper, MotionLoRAInfo]]):
+    # patch LoRA deltas into the loaded weights in place; undone by motion_module.restore_weight_patches()
+    # cached LoRA wrappers are shared between runs, so name and strength come from each run's own MotionLoRAInfo
+    model_has_midblock = has_mid_block(motion_module.state_dict())
 
     def get_version(has_midblock: bool):
         return "v2" if has_midblock else "v1"
 
-    logger.info(f"Applying a {get_version(lora_has_midblock)} LoRA ({lora.info.name}) to a {get_version(model_has_midblock)} motion model.")
+    # sum deltas of all LoRAs first, so that each weight is only patched once
+    summed_deltas: dict[str, Tensor] = {}
+    for lora, lora_info in loras:
+        logger.info(f"Applying a {get_version(lora.has_midblock)} LoRA ({lora_info.name}) to a {get_version(model_has_midblock)} motion model.")
+        # deltas are cached unscaled on the LoRA, so only strength needs to be applied here
+        for model_key, delta in lora.get_deltas(include_midblock=model_has_midblock).items():
+            if model_key in summed_deltas:
+                summed_deltas[model_key].add_(delta, alpha=lora_info.strength)
+            else:
+                summed_deltas[model_key] = delta.float() * lora_info.strength
+    for model_key, delta in summed_deltas.items():
+        motion_module.add_weight_patch(model_key, delta)
 
-    for key in lora.state_dict:
-        # if motion model doesn't have a mid_block, skip mid_block entries
-        if not model_has_midblock:
-            if "mid_block" in key: continue
-        # only process lora down key (we will process up at the same time as down)
-        if "up." in key: continue
-        
-        # key to get up value
-        up_key = key.replace(".down.", ".up.")
-        # adapt key to match model_dict format - remove 'processor.', '_lora', 'down.', and 'up.'
-        model_key = key.replace("processor.", "").replace("_lora", "").replace("down.", "").replace("up.", "")
-        # model keys have a '0.' after all 'to_out.' weight keys
-        model_key = model_key.replace("to_out.", "to_out.0.")
 
-        weight_down = lora.state_dict[key]
-        weight_up = lora.state_dict[up_key]
-        # apply weights to model_dict - multiply strength by matrix multiplication of up and down weights
-        model_dict[model_key] += lora.info.strength * torch.mm(weight_up, weight_down).to(model_dict[model_key].device)
+def load_motion_loras(motion_lora: MotionLoRAList) -> list[tuple[MotionLoRAWrapper, MotionLoRAInfo]]:
+    # returns (cached LoRA, info of this run) pairs; the cached LoRA itself is never modified per run
+    loras = []
+    for lora_info in motion_lora.loras:
+        lora = load_motion_lora(lora_info.name)
+        loras.append((lora, lora_info.clone()))
+    loras.sort(key=lambda x: x[0].hash)
+    return loras
 
 
 def load_motion_lora(lora_name: str) -> MotionLoRAWrapper:
     # if already loaded, return it
     lora_path = get_motion_lora_path(lora_name)
-    lora_hash = calculate_file_hash(lora_path, hash_every_n=3)
+    lora_hash = get_file_hash(lora_path, hash_every_n=3)
 
-    if lora_hash in motion_loras:
-        return motion_loras[lora_hash]
+    lora = motion_loras.get(lora_hash)
+    if lora is not None:
+        return lora
     
     logger.info(f"Loading motion LoRA {lora_name}")
     l_state_dict = load_torch_file(lora_path)
     lora = MotionLoRAWrapper(l_state_dict, lora_hash)
     # add motion LoRA to cache
-    motion_loras[lora_hash] = lora
+    motion_loras.put(lora_hash, lora)
     return lora
 
 
@@ -170,59 +170,57 @@ def apply_mm_settings(model_dict: dict[str, Tensor], mm_settings: 'MotionModelSe
     return model_dict
     #cond_or_uncond = inspect.currentframe().f_back.f_locals["transformer_options"]["cond_or_uncond"]
 
-def load_motion_module(model_name: str, motion_lora: MotionLoRAList = None, model: ModelPatcher = None, motion_model_settings = None) -> GenericMotionWrapper:
+def load_motion_module(model_name: str, model: ModelPatcher = None, motion_model_settings = None,
+                       quantize_int8: bool=False) -> GenericMotionWrapper:
     # if already loaded, return it
     model_path = get_motion_model_path(model_name)
-    model_hash = calculate_file_hash(model_path, hash_every_n=50)
+    model_hash = get_file_hash(model_path, hash_every_n=50)
 
-    # load lora, if present
-    loras = []
-    if motion_lora is not None:
-        for lora_info in motion_lora.loras:
-            lora = load_motion_lora(lora_info.name)
-            lora.set_info(lora_info)
-            loras.append(lora)
-        loras.sort(key=lambda x: x.hash)
-        # use lora hashes with model hash
-        for lora in loras:
-            model_hash += lora.hash
-        model_hash = str(hash(model_hash))
-
-    # models are determined by combo self + applied loras
-    if model_hash in motion_modules:
-        return motion_modules[model_hash]
+    # motion LoRAs are not baked in; they are patched in at sampling time via apply_motion_loras,
+    # so the same loaded module is shared regardless of LoRAs
+    # int8 modules are cached separately from full precision ones
+    if quantize_int8:
+        model_hash = f"{model_hash}_int8"
+
+    motion_module = motion_modules.get(model_hash)
+    if motion_module is not None:
+        return motion_module
 
     logger.info(f"Loading motion module {model_name}")
-    mm_state_dict = load_torch_file(model_path)
+    # when possible, map safetensors tensors straight into the motion module instead of copying them
+    mm_state_dict = None
+    if is_mmap_load_supported(model_path):
+        try:
+            mm_state_dict = load_safetensors_mmap(model_path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Could not memory-map motion module {model_name}, loading it normally instead: {e}")
+    use_mmap = mm_state_dict is not None
+    if not use_mmap:
+        mm_state_dict = load_torch_file(model_path)
 
     if motion_model_settings != None:
         mm_state_dict = apply_mm_settings(mm_state_dict, motion_model_settings)
 
-    # load lora state dicts if exist
-    if len(loras) > 0:
-        for lora in loras:
-            # apply LoRA to mm_state_dict
-            apply_lora_to_mm_state_dict(mm_state_dict, lora)
-
-
     # determine if motion module is SD_1.5 compatible or SDXL compatible
     sd_model_type = ModelTypesSD.SD1_5
     if model is not None:
         sd_model_type = get_sd_model_type(model)
     
     motion_module: GenericMotionWrapper = None
-    if sd_model_type == ModelTypesSD.SD1_5:
-        try:
-            motion_module = AnimDiffMotionWrapper(mm_state_dict=mm_state_dict, mm_hash=model_hash, mm_name=model_name, loras=loras)
-        except ValueError as e:
-            raise ValueError(f"Motion model {model_name} is not compatible with SD1.5-based model.", e)
-    elif sd_model_type == ModelTypesSD.SDXL:
-        try:
-            motion_module = HotShotXLMotionWrapper(mm_state_dict=mm_state_dict, mm_hash=model_hash, mm_name=model_name, loras=loras)
-        except ValueError as e:
-            raise ValueError(f"Motion model {model_name} is not compatible with SDXL-based model.", e)
-    else:
-        raise ValueError(f"SD model must be either SD1.5-based for AnimateDiff or SDXL-based for HotShotXL.")
+    # mapped weights get assigned to the module, so don't allocate (and initialize) weights that would be replaced
+    with torch.device("meta") if use_mmap else nullcontext():
+        if sd_model_type == ModelTypesSD.SD1_5:
+            try:
+                motion_module = AnimDiffMotionWrapper(mm_state_dict=mm_state_dict, mm_hash=model_hash, mm_name=model_name, loras=None)
+            except ValueError as e:
+                raise ValueError(f"Motion model {model_name} is not compatible with SD1.5-based model.", e)
+        elif sd_model_type == ModelTypesSD.SDXL:
+            try:
+                motion_module = HotShotXLMotionWrapper(mm_state_dict=mm_state_dict, mm_hash=model_hash, mm_name=model_name, loras=None)
+            except ValueError as e:
+                raise ValueError(f"Motion model {model_name} is not compatible with SDXL-based model.", e)
+        else:
+            raise ValueError(f"SD model must be either SD1.5-based for AnimateDiff or SDXL-based for HotShotXL.")
 
 
     # continue loading model
@@ -230,16 +228,37 @@ def load_motion_module(model_name: str, motion_lora: MotionLoRAList = None, mode
     usefp16 = model_management.should_use_fp16(model_params=parameters)
     if usefp16:
         logger.info("Using fp16, converting motion module to fp16")
-        motion_module.half()
     offload_device = model_management.unet_offload_device()
-    motion_module = motion_module.to(offload_device)
-    motion_module.load_state_dict(mm_state_dict)
+    if use_mmap:
+        # only tensors not already in the target dtype get converted (and thereby copied out of the mapping)
+        dtype = torch.float16 if usefp16 else torch.float32
+        for key, tensor in mm_state_dict.items():
+            if tensor.is_floating_point() and tensor.dtype != dtype:
+                mm_state_dict[key] = tensor.to(dtype)
+        motion_module.load_state_dict(mm_state_dict, assign=True)
+        motion_module = motion_module.to(offload_device)
+    else:
+        if usefp16:
+            motion_module.half()
+        motion_module = motion_module.to(offload_device)
+        motion_module.load_state_dict(mm_state_dict)
+    if quantize_int8:
+        motion_module.quantize_int8()
 
     # add to motion_module cache
-    motion_modules[model_hash] = motion_module
+    motion_modules.put(model_hash, motion_module)
     return motion_module
 
 
+def pin_motion_module(motion_module: GenericMotionWrapper):
+    # keep motion module from being evicted from cache while in use
+    motion_modules.pin(motion_module.mm_hash)
+
+
+def unpin_motion_module(motion_module: GenericMotionWrapper):
+    motion_modules.unpin(motion_module.mm_hash)
+
+
 def unload_motion_module(motion_module: GenericMotionWrapper):
     logger.info(f"Removing motion module {motion_module.mm_name} from cache")
     motion_modules.pop(motion_module.mm_hash, None)
@@ -446,7 +465,8 @@ MM_UNET_INJECTION_ATTR = "_mm_is_unet_injected"
 
 class InjectionParams:
     def __init__(self, video_length: int, unlimited_area_hack: bool, apply_mm_groupnorm_hack: bool, beta_schedule: str, injector: str, model_name: str,
-                 apply_v2_models_properly: bool=False) -> None:
+                 apply_v2_models_properly: bool=False, fuse_qkv: bool=False, autotune_attention: bool=False,
+                 start_percent: float=0.0, end_percent: float=1.0, torch_compile: bool=False, quantize_int8: bool=False) -> None:
         self.video_length = video_length
         self.unlimited_area_hack = unlimited_area_hack
         self.apply_mm_groupnorm_hack = apply_mm_groupnorm_hack
@@ -454,12 +474,22 @@ class InjectionParams:
         self.injector = injector
         self.model_name = model_name
         self.apply_v2_models_properly = apply_v2_models_properly
+        self.fuse_qkv = fuse_qkv
+        self.autotune_attention = autotune_attention
+        # fraction of sampling steps that motion modules are applied on; bypassed outside of range
+        self.start_percent = start_percent
+        self.end_percent = end_percent
+        self.torch_compile = torch_compile
+        self.quantize_int8 = quantize_int8
+        self.motion_cache_options: MotionCacheOptions = None
         self.context_length: int = None
         self.context_stride: int = None
         self.context_overlap: int = None
         self.context_schedule: str = None
         self.closed_loop: bool = False
         self.sync_context_to_pe = False
+        self.batch_windows = False
+        self.min_coverage = 1
         self.version: str = None
         self.loras: MotionLoRAList = None
         self.motion_model_settings = MotionModelSettings()
@@ -467,17 +497,23 @@ class InjectionParams:
     def set_version(self, motion_module: GenericMotionWrapper):
         self.version = motion_module.version
 
-    def set_context(self, context_length: int, context_stride: int, context_overlap: int, context_schedule: str, closed_loop: bool, sync_context_to_pe: bool=False):
+    def set_context(self, context_length: int, context_stride: int, context_overlap: int, context_schedule: str, closed_loop: bool, sync_context_to_pe: bool=False,
+                    batch_windows: bool=False, min_coverage: int=1):
         self.context_length = context_length
         self.context_stride = context_stride
         self.context_overlap = context_overlap
         self.context_schedule = context_schedule
         self.closed_loop = closed_loop
         self.sync_context_to_pe = sync_context_to_pe
+        self.batch_windows = batch_windows
+        self.min_coverage = min_coverage
     
     def set_loras(self, loras: MotionLoRAList):
         self.loras = loras.clone()
     
+    def set_motion_cache_options(self, motion_cache_options: MotionCacheOptions):
+        self.motion_cache_options = motion_cache_options
+
     def set_motion_model_settings(self, motion_model_settings: 'MotionModelSettings'):
         if motion_model_settings is None:
             self.motion_model_settings = MotionModelSettings()
@@ -490,21 +526,28 @@ class InjectionParams:
         self.context_overlap = None
         self.context_schedule = None
         self.closed_loop = False
+        self.batch_windows = False
+        self.min_coverage = 1
     
     def clone(self) -> 'InjectionParams':
         new_params = InjectionParams(
             self.video_length, self.unlimited_area_hack, self.apply_mm_groupnorm_hack,
             self.beta_schedule, self.injector, self.model_name, apply_v2_models_properly=self.apply_v2_models_properly,
+            fuse_qkv=self.fuse_qkv, autotune_attention=self.autotune_attention,
+            start_percent=self.start_percent, end_percent=self.end_percent, torch_compile=self.torch_compile,
+            quantize_int8=self.quantize_int8,
             )
         new_params.version = self.version
         new_params.set_context(
             context_length=self.context_length, context_stride=self.context_stride,
             context_overlap=self.context_overlap, context_schedule=self.context_schedule,
             closed_loop=self.closed_loop, sync_context_to_pe=self.sync_context_to_pe,
+            batch_windows=self.batch_windows, min_coverage=self.min_coverage,
             )
         if self.loras is not None:
             new_params.loras = self.loras.clone()
         new_params.set_motion_model_settings(self.motion_model_settings)
+        new_params.set_motion_cache_options(self.motion_cache_options)
         return new_params
         
 
@@ -558,6 +601,8 @@ class MotionModelSettings:
                  initial_pe_idx_offset: int=0, final_pe_idx_offset: int=0,
                  motion_pe_stretch: int=0,
                  attn_scale: float=1.0,
+                 attn_chunk_size: int=0,
+                 attn_chunk_memory_mb: int=0,
                  ):
         # general strengths
         self.pe_strength = pe_strength
@@ -577,6 +622,9 @@ class MotionModelSettings:
         self.motion_pe_stretch = motion_pe_stretch
         # attention scale settings
         self.attn_scale = attn_scale
+        # attention chunking settings; runtime-only, so not part of has_anything_to_apply
+        self.attn_chunk_size = attn_chunk_size
+        self.attn_chunk_memory_mb = attn_chunk_memory_mb
 
     def has_pe_strength(self) -> bool:
         return self.pe_strength != 1.0
@@ -602,6 +650,9 @@ class MotionModelSettings:
     def has_motion_pe_stretch(self) -> bool:
         return self.motion_pe_stretch > 0
 
+    def has_attn_chunking(self) -> bool:
+        return self.attn_chunk_size > 0 or self.attn_chunk_memory_mb > 0
+
     def has_anything_to_apply(self) -> bool:
         return self.has_pe_strength() \
             or self.has_attn_strength() \
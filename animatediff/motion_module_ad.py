@@ -2,12 +2,13 @@ import math
 from typing import Iterable, Union
 
 import torch
-from einops import rearrange, repeat
+from einops import repeat
 from torch import Tensor, nn
 
 from comfy.ldm.modules.attention import FeedForward
 from .motion_lora import MotionLoRAInfo
-from .motion_utils import GenericMotionWrapper, GroupNormAD, InjectorVersion, BlockType, CrossAttentionMM
+from .motion_utils import GenericMotionWrapper, GroupNormAD, InjectorVersion, BlockType, CrossAttentionMM, \
+    CompiledForward, is_default_scale_multiplier
 
 
 def zero_module(module):
@@ -68,6 +69,10 @@ class AnimDiffMotionWrapper(GenericMotionWrapper):
             self.mid_block.set_video_length(video_length)
     
     def set_scale_multiplier(self, multiplier: Union[float, None]):
+        # skip walking the blocks when nothing is or will be folded into weights
+        if is_default_scale_multiplier(multiplier) and is_default_scale_multiplier(self.scale_multiplier):
+            return
+        self.scale_multiplier = multiplier
         for block in self.down_blocks:
             block.set_scale_multiplier(multiplier)
         for block in self.up_blocks:
@@ -83,6 +88,9 @@ class AnimDiffMotionWrapper(GenericMotionWrapper):
         if self.mid_block is not None:
             self.mid_block.set_sub_idxs(sub_idxs)
 
+    def get_int8_excluded_types(self) -> tuple[type, ...]:
+        return super().get_int8_excluded_types() + (PositionalEncoding,)
+
 
 class MotionModule(nn.Module):
     def __init__(self, in_channels, temporal_position_encoding_max_len=24, block_type: str=BlockType.DOWN):
@@ -114,6 +122,13 @@ class MotionModule(nn.Module):
         for motion_module in self.motion_modules:
             motion_module.set_sub_idxs(sub_idxs)
 
+    def get_temporal_modules(self) -> list['VanillaTemporalModule']:
+        return list(self.motion_modules)
+
+    def set_compiled(self, compiled: bool):
+        for motion_module in self.motion_modules:
+            motion_module.set_compiled(compiled)
+
 
 def get_motion_module(in_channels, temporal_position_encoding_max_len):
     return VanillaTemporalModule(in_channels=in_channels, temporal_position_encoding_max_len=temporal_position_encoding_max_len)
@@ -151,6 +166,8 @@ class VanillaTemporalModule(nn.Module):
             self.temporal_transformer.proj_out = zero_module(
                 self.temporal_transformer.proj_out
             )
+        # set while sampling if outputs of this module should be cached across steps
+        self.motion_cache_id: int = None
 
     def set_video_length(self, video_length: int):
         self.temporal_transformer.set_video_length(video_length)
@@ -161,6 +178,9 @@ class VanillaTemporalModule(nn.Module):
     def set_sub_idxs(self, sub_idxs: list[int]):
         self.temporal_transformer.set_sub_idxs(sub_idxs)
 
+    def set_compiled(self, compiled: bool):
+        self.temporal_transformer.set_compiled(compiled)
+
     def forward(self, input_tensor, encoder_hidden_states=None, attention_mask=None):
         return self.temporal_transformer(input_tensor, encoder_hidden_states, attention_mask)
 
@@ -217,6 +237,9 @@ class TemporalTransformer3DModel(nn.Module):
         )
         self.proj_out = nn.Linear(inner_dim, in_channels)
         self.video_length = 16
+        # torch.compile'd forward_blocks; kept on module so compiled graphs survive between runs
+        self.compiled_forward: CompiledForward = None
+        self.use_compiled = False
 
     def set_video_length(self, video_length: int):
         self.video_length = video_length
@@ -229,15 +252,34 @@ class TemporalTransformer3DModel(nn.Module):
         for block in self.transformer_blocks:
             block.set_sub_idxs(sub_idxs)
 
+    def set_compiled(self, compiled: bool):
+        if compiled and self.compiled_forward is None:
+            self.compiled_forward = CompiledForward(self.forward_blocks)
+        self.use_compiled = compiled
+
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
         batch, channel, height, weight = hidden_states.shape
         residual = hidden_states
 
+        # GroupNorm stays eager, since its forward gets patched while sampling
         hidden_states = self.norm(hidden_states)
-        inner_dim = hidden_states.shape[1]
-        hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(
-            batch, height * weight, inner_dim
-        )
+        if self.use_compiled:
+            bucket = (self.video_length, height, weight, hidden_states.dtype, hidden_states.device)
+            hidden_states = self.compiled_forward(bucket, hidden_states, encoder_hidden_states, attention_mask)
+        else:
+            hidden_states = self.forward_blocks(hidden_states, encoder_hidden_states, attention_mask)
+
+        output = hidden_states + residual
+
+        return output
+
+    def forward_blocks(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
+        batch, inner_dim, height, weight = hidden_states.shape
+        # go straight to temporal-major layout, (b f) c h w -> (b h w) f c, with a single permute;
+        # all blocks (norms, attention, ff) operate per-token, so they run in this layout as-is
+        video_batch = batch // self.video_length
+        hidden_states = hidden_states.reshape(video_batch, self.video_length, inner_dim, height * weight).permute(
+            0, 3, 1, 2).reshape(video_batch * height * weight, self.video_length, inner_dim)
         hidden_states = self.proj_in(hidden_states)
 
         # Transformer Blocks
@@ -251,15 +293,13 @@ class TemporalTransformer3DModel(nn.Module):
 
         # output
         hidden_states = self.proj_out(hidden_states)
+        # back from temporal-major layout, (b h w) f c -> (b f) c h w, with a single permute
         hidden_states = (
-            hidden_states.reshape(batch, height, weight, inner_dim)
-            .permute(0, 3, 1, 2)
-            .contiguous()
+            hidden_states.reshape(video_batch, height * weight, self.video_length, inner_dim)
+            .permute(0, 2, 3, 1)
+            .reshape(batch, inner_dim, height, weight)
         )
-
-        output = hidden_states + residual
-
-        return output
+        return hidden_states
 
 
 class TemporalTransformerBlock(nn.Module):
@@ -402,12 +442,6 @@ class VersatileAttention(CrossAttentionMM):
     def extra_repr(self):
         return f"(Module Info) Attention_Mode: {self.attention_mode}, Is_Cross_Attention: {self.is_cross_attention}"
 
-    def set_scale_multiplier(self, multiplier: Union[float, None]):
-        if multiplier is None or math.isclose(multiplier, 1.0):
-            self.scale = None
-        else:
-            self.scale = self.default_scale * multiplier
-
     def set_sub_idxs(self, sub_idxs: list[int]):
         if self.pos_encoder != None:
             self.pos_encoder.set_sub_idxs(sub_idxs)
@@ -422,19 +456,13 @@ class VersatileAttention(CrossAttentionMM):
         if self.attention_mode != "Temporal":
             raise NotImplementedError
 
-        d = hidden_states.shape[1]
-        hidden_states = rearrange(
-            hidden_states, "(b f) d c -> (b d) f c", f=video_length
-        )
-
+        # hidden_states are already in temporal-major layout, (b d) f c - see TemporalTransformer3DModel
         if self.pos_encoder is not None:
            hidden_states = self.pos_encoder(hidden_states)
 
-        encoder_hidden_states = (
-            repeat(encoder_hidden_states, "b n c -> (b d) n c", d=d)
-            if encoder_hidden_states is not None
-            else encoder_hidden_states
-        )
+        if encoder_hidden_states is not None:
+            d = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+            encoder_hidden_states = repeat(encoder_hidden_states, "b n c -> (b d) n c", d=d)
 
         hidden_states = super().forward(
             hidden_states,
@@ -443,6 +471,4 @@ class VersatileAttention(CrossAttentionMM):
             mask=attention_mask,
         )
 
-        hidden_states = rearrange(hidden_states, "(b d) f c -> (b f) d c", d=d)
-
         return hidden_states
@@ -3,12 +3,13 @@ import math
 from typing import Iterable, Optional, Union
 
 import torch
-from einops import rearrange, repeat
+from einops import repeat
 from torch import Tensor, nn
 
 from comfy.ldm.modules.attention import FeedForward
 from .motion_lora import MotionLoRAInfo
-from .motion_utils import GenericMotionWrapper, GroupNormAD, InjectorVersion, BlockType, CrossAttentionMM
+from .motion_utils import GenericMotionWrapper, GroupNormAD, InjectorVersion, BlockType, CrossAttentionMM, \
+    CompiledForward, is_default_scale_multiplier
 
 
 def zero_module(module):
@@ -76,6 +77,10 @@ class HotShotXLMotionWrapper(GenericMotionWrapper):
             self.mid_block.set_video_length(video_length)
     
     def set_scale_multiplier(self, multiplier: Union[float, None]):
+        # skip walking the blocks when nothing is or will be folded into weights
+        if is_default_scale_multiplier(multiplier) and is_default_scale_multiplier(self.scale_multiplier):
+            return
+        self.scale_multiplier = multiplier
         for block in self.down_blocks:
             block.set_scale_multiplier(multiplier)
         for block in self.up_blocks:
@@ -85,6 +90,9 @@ class HotShotXLMotionWrapper(GenericMotionWrapper):
 
     def set_sub_idxs(self, sub_idxs: list[int]):
         pass
+
+    def get_int8_excluded_types(self) -> tuple[type, ...]:
+        return super().get_int8_excluded_types() + (PositionalEncoding,)
         
 
 class HotShotXLMotionModule(nn.Module):
@@ -113,6 +121,13 @@ class HotShotXLMotionModule(nn.Module):
         for tt in self.temporal_attentions:
             tt.set_scale_multiplier(multiplier)
 
+    def get_temporal_modules(self) -> list['TransformerTemporal']:
+        return list(self.temporal_attentions)
+
+    def set_compiled(self, compiled: bool):
+        for tt in self.temporal_attentions:
+            tt.set_compiled(compiled)
+
 
 def get_transformer_temporal(in_channels, max_length) -> 'TransformerTemporal':
     num_attention_heads = 8
@@ -164,6 +179,11 @@ class TransformerTemporal(nn.Module):
         )
         self.proj_out = nn.Linear(inner_dim, in_channels)
         self.video_length = 8
+        # torch.compile'd forward_blocks; kept on module so compiled graphs survive between runs
+        self.compiled_forward: CompiledForward = None
+        self.use_compiled = False
+        # set while sampling if outputs of this module should be cached across steps
+        self.motion_cache_id: int = None
 
     def set_video_length(self, video_length: int):
         self.video_length = video_length
@@ -172,15 +192,34 @@ class TransformerTemporal(nn.Module):
         for block in self.transformer_blocks:
             block.set_scale_multiplier(multiplier)
 
+    def set_compiled(self, compiled: bool):
+        if compiled and self.compiled_forward is None:
+            self.compiled_forward = CompiledForward(self.forward_blocks)
+        self.use_compiled = compiled
+
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
         batch, channel, height, weight = hidden_states.shape
         residual = hidden_states
 
+        # GroupNorm stays eager, since its forward gets patched while sampling
         hidden_states = self.norm(hidden_states)
-        inner_dim = hidden_states.shape[1]
-        hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(
-            batch, height * weight, inner_dim
-        )
+        if self.use_compiled:
+            bucket = (self.video_length, height, weight, hidden_states.dtype, hidden_states.device)
+            hidden_states = self.compiled_forward(bucket, hidden_states, encoder_hidden_states, attention_mask)
+        else:
+            hidden_states = self.forward_blocks(hidden_states, encoder_hidden_states, attention_mask)
+
+        output = hidden_states + residual
+
+        return output
+
+    def forward_blocks(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
+        batch, inner_dim, height, weight = hidden_states.shape
+        # go straight to temporal-major layout, (b f) c h w -> (b h w) f c, with a single permute;
+        # all blocks (norms, attention, ff) operate per-token, so they run in this layout as-is
+        video_batch = batch // self.video_length
+        hidden_states = hidden_states.reshape(video_batch, self.video_length, inner_dim, height * weight).permute(
+            0, 3, 1, 2).reshape(video_batch * height * weight, self.video_length, inner_dim)
         hidden_states = self.proj_in(hidden_states)
 
         # Transformer Blocks
@@ -193,15 +232,13 @@ class TransformerTemporal(nn.Module):
 
         # output
         hidden_states = self.proj_out(hidden_states)
+        # back from temporal-major layout, (b h w) f c -> (b f) c h w, with a single permute
         hidden_states = (
-            hidden_states.reshape(batch, height, weight, inner_dim)
-            .permute(0, 3, 1, 2)
-            .contiguous()
+            hidden_states.reshape(video_batch, height * weight, self.video_length, inner_dim)
+            .permute(0, 2, 3, 1)
+            .reshape(batch, inner_dim, height, weight)
         )
-
-        output = hidden_states + residual
-
-        return output
+        return hidden_states
 
 
 class TransformerBlock(nn.Module):
@@ -308,20 +345,12 @@ class TemporalAttention(CrossAttentionMM):
         super().__init__(*args, **kwargs)
         self.pos_encoder = PositionalEncoding(kwargs["query_dim"], dropout=0, max_length=max_length)
 
-    def set_scale_multiplier(self, multiplier: Union[float, None]):
-        if multiplier is None or math.isclose(multiplier, 1.0):
-            self.scale = None
-        else:
-            self.scale = self.default_scale * multiplier
-
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, number_of_frames=8):
-        sequence_length = hidden_states.shape[1]
-        hidden_states = rearrange(hidden_states, "(b f) s c -> (b s) f c", f=number_of_frames)
+        # hidden_states are already in temporal-major layout, (b s) f c - see TransformerTemporal
         hidden_states = self.pos_encoder(hidden_states, length=number_of_frames)
 
-        if encoder_hidden_states:
+        if encoder_hidden_states is not None:
+            sequence_length = hidden_states.shape[0] // encoder_hidden_states.shape[0]
             encoder_hidden_states = repeat(encoder_hidden_states, "b n c -> (b s) n c", s=sequence_length)
 
-        hidden_states = super().forward(hidden_states, encoder_hidden_states, mask=attention_mask)
-
-        return rearrange(hidden_states, "(b s) f c -> (b f) s c", s=sequence_length)
+        return super().forward(hidden_states, encoder_hidden_states, mask=attention_mask)
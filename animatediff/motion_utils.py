@@ -1,5 +1,6 @@
+import math
 from abc import ABC, abstractmethod
-from typing import Union
+from typing import Callable, Union
 
 import torch
 import torch.nn.functional as F
@@ -9,6 +10,9 @@ import comfy.model_management as model_management
 import comfy.ops
 from comfy.cli_args import args
 from comfy.ldm.modules.attention import attention_basic, attention_pytorch, attention_split, attention_sub_quad, default
+from .attention_autotune import attention_autotuner
+from .logger import logger
+from .motion_cache import MotionCacheOptions
 from .motion_lora import MotionLoRAInfo
 
 # until xformers bug is fixed, do not use xformers for VersatileAttention! TODO: change this when fix is out
@@ -26,16 +30,127 @@ else:
         optimized_attention_mm = attention_sub_quad
 
 
+def is_default_scale_multiplier(multiplier: Union[float, None]) -> bool:
+    return multiplier is None or math.isclose(multiplier, 1.0)
+
+
+class Int8Linear(nn.Module):
+    # weight-only int8 Linear with per-output-channel scales; weights are dequantized on the fly to the input's dtype
+    def __init__(self, in_features: int, out_features: int, bias: bool=True, dtype=None, device=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight_int8", torch.zeros((out_features, in_features), dtype=torch.int8, device=device))
+        self.register_buffer("weight_scale", torch.ones((out_features, 1), dtype=dtype, device=device))
+        if bias:
+            self.bias = nn.Parameter(torch.zeros(out_features, dtype=dtype, device=device), requires_grad=False)
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Module) -> 'Int8Linear':
+        weight = linear.weight.detach()
+        int8_linear = cls(weight.shape[1], weight.shape[0], bias=linear.bias is not None, dtype=weight.dtype, device=weight.device)
+        int8_linear.set_weight(weight)
+        if linear.bias is not None:
+            int8_linear.bias.data.copy_(linear.bias.detach())
+        return int8_linear
+
+    def set_weight(self, weight: Tensor):
+        # symmetric quantization, so that each output channel's max magnitude maps to 127
+        with torch.no_grad():
+            weight = weight.float()
+            scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127.0
+            self.weight_int8.copy_(torch.round(weight / scale).clamp(-127, 127).to(torch.int8))
+            self.weight_scale.copy_(scale)
+
+    @classmethod
+    def cat(cls, linears: list['Int8Linear']) -> 'Int8Linear':
+        # concatenate along output channels; per-channel scales make this exact
+        first = linears[0]
+        has_bias = first.bias is not None
+        int8_linear = cls(first.in_features, sum(linear.out_features for linear in linears), bias=has_bias,
+                          dtype=first.weight_scale.dtype, device=first.weight_scale.device)
+        int8_linear.weight_int8.copy_(torch.cat([linear.weight_int8 for linear in linears], dim=0))
+        int8_linear.weight_scale.copy_(torch.cat([linear.weight_scale for linear in linears], dim=0))
+        if has_bias:
+            int8_linear.bias.data.copy_(torch.cat([linear.bias.detach() for linear in linears], dim=0))
+        return int8_linear
+
+    def dequantize_weight(self, dtype: torch.dtype=None) -> Tensor:
+        dtype = dtype if dtype is not None else self.weight_scale.dtype
+        return self.weight_int8.to(dtype) * self.weight_scale.to(dtype)
+
+    def forward(self, x: Tensor) -> Tensor:
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, self.dequantize_weight(x.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+# comfy.ops.Linear is not a subclass of nn.Linear in all ComfyUI versions
+LINEAR_TYPES = tuple(t for t in (nn.Linear, getattr(comfy.ops, "Linear", None)) if isinstance(t, type))
+
+
+def is_linear_layer(module: nn.Module) -> bool:
+    return isinstance(module, LINEAR_TYPES)
+
+
+def has_matrix_weight(module: nn.Module) -> bool:
+    # layers that are not Linear but hold a 2D weight are reported as skipped, so unusual layers do not go unnoticed
+    weight = getattr(module, "weight", None)
+    return not isinstance(module, Int8Linear) and isinstance(weight, Tensor) and weight.dim() == 2
+
+
+def get_layer_type_name(module: nn.Module) -> str:
+    return f"{type(module).__module__}.{type(module).__qualname__}"
+
+
+def quantize_linears_int8(module: nn.Module, report: list[tuple[str, str, float]]=None, prefix: str="",
+                          excluded_types: tuple[type, ...]=(), skipped: list[tuple[str, str]]=None) -> int:
+    # replace all Linear layers within module with Int8Linear, except within excluded types; returns amount replaced
+    count = 0
+    for name, child in list(module.named_children()):
+        full_name = f"{prefix}{name}"
+        if isinstance(child, excluded_types):
+            continue
+        if is_linear_layer(child):
+            int8_linear = Int8Linear.from_linear(child)
+            if report is not None:
+                report.append((full_name, get_layer_type_name(child), get_int8_linear_error(child, int8_linear)))
+            setattr(module, name, int8_linear)
+            count += 1
+            continue
+        if skipped is not None and has_matrix_weight(child):
+            skipped.append((full_name, get_layer_type_name(child)))
+        count += quantize_linears_int8(child, report, prefix=f"{full_name}.", excluded_types=excluded_types, skipped=skipped)
+    return count
+
+
+def get_int8_linear_error(linear: nn.Module, int8_linear: Int8Linear, samples: int=64, seed: int=0) -> float:
+    # relative error of quantized output vs. original output on fixed, seeded inputs
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    x = torch.randn((samples, linear.weight.shape[1]), generator=generator, dtype=torch.float32).to(linear.weight.device)
+    with torch.no_grad():
+        reference = F.linear(x, linear.weight.float())
+        quantized = F.linear(x, int8_linear.dequantize_weight(torch.float32))
+        return ((quantized - reference).norm() / reference.norm().clamp(min=1e-12)).item()
+
+
 class CrossAttentionMM(nn.Module):
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., dtype=None, device=None, operations=comfy.ops):
         super().__init__()
         inner_dim = dim_head * heads
+        # q, k, and v projections can only be fused when they all take the same input (self-attention)
+        self.can_fuse_qkv = context_dim is None
         context_dim = default(context_dim, query_dim)
 
         self.heads = heads
         self.dim_head = dim_head
-        self.scale = None
-        self.default_scale = dim_head ** -0.5
+        # custom scale is folded into to_k weights; original weights are kept to be restored exactly
+        self.scale_multiplier: Union[float, None] = None
+        self.to_k_backup: Tensor = None
 
         self.to_q = operations.Linear(query_dim, inner_dim, bias=False, dtype=dtype, device=device)
         self.to_k = operations.Linear(context_dim, inner_dim, bias=False, dtype=dtype, device=device)
@@ -43,24 +158,159 @@ class CrossAttentionMM(nn.Module):
 
         self.to_out = nn.Sequential(operations.Linear(inner_dim, query_dim, dtype=dtype, device=device), nn.Dropout(dropout))
 
-    def forward(self, x, context=None, value=None, mask=None):
-        q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        if value is not None:
-            v = self.to_v(value)
-            del value
+        # fused projection; only set while fused, with original projections kept aside to be restored
+        self.to_qkv = None
+        self.unfused_qkv: tuple[nn.Linear, nn.Linear, nn.Linear] = None
+
+        # chunking of the (b d) sequence batch to cap peak memory; 0 means disabled
+        self.attn_chunk_size = 0
+        self.attn_chunk_memory_mb = 0
+        # pick attention backend per shape bucket by timing them, instead of global flags
+        self.autotune_attention = False
+
+    def fuse_qkv(self):
+        if not self.can_fuse_qkv or self.to_qkv is not None:
+            return
+        if isinstance(self.to_q, Int8Linear):
+            to_qkv = Int8Linear.cat([self.to_q, self.to_k, self.to_v])
         else:
-            v = self.to_v(context)
+            weight = torch.cat([self.to_q.weight, self.to_k.weight, self.to_v.weight], dim=0)
+            to_qkv = comfy.ops.Linear(weight.shape[1], weight.shape[0], bias=False, dtype=weight.dtype, device=weight.device)
+            to_qkv.weight = nn.Parameter(weight, requires_grad=False)
+        # unregister original projections, so only the fused weights get moved to the sampling device
+        self.unfused_qkv = (self.to_q, self.to_k, self.to_v)
+        self.to_q = None
+        self.to_k = None
+        self.to_v = None
+        self.to_qkv = to_qkv
+
+    def unfuse_qkv(self):
+        if self.to_qkv is None:
+            return
+        self.to_q, self.to_k, self.to_v = self.unfused_qkv
+        self.unfused_qkv = None
+        self.to_qkv = None
 
-        # apply custom scale by multiplying k by scale factor;
-        # division by default_scale is needed to account for internal attn code multiplying by default_scale
-        if self.scale is not None:
-            k *= (self.scale / self.default_scale)
-        out = optimized_attention_mm(q, k, v, self.heads, mask)
+    def get_to_k_scalable_weight(self) -> Tensor:
+        # for int8 weights, per-channel scales get multiplied instead
+        if isinstance(self.to_k, Int8Linear):
+            return self.to_k.weight_scale
+        return self.to_k.weight
+
+    def set_scale_multiplier(self, multiplier: Union[float, None]):
+        # multiplying k by multiplier is equivalent to multiplying to_k's weights by it (no bias)
+        self.restore_scale_multiplier()
+        if is_default_scale_multiplier(multiplier):
+            return
+        weight = self.get_to_k_scalable_weight()
+        with torch.no_grad():
+            self.to_k_backup = weight.detach().clone()
+            weight.mul_(multiplier)
+        self.scale_multiplier = multiplier
+
+    def restore_scale_multiplier(self):
+        if self.to_k_backup is None:
+            return
+        with torch.no_grad():
+            self.get_to_k_scalable_weight().copy_(self.to_k_backup)
+        self.to_k_backup = None
+        self.scale_multiplier = None
+
+    def set_attn_chunking(self, chunk_size: int=0, memory_mb: int=0):
+        self.attn_chunk_size = chunk_size
+        self.attn_chunk_memory_mb = memory_mb
+
+    def get_attn_chunk_size(self, x: Tensor, context: Tensor=None) -> int:
+        batch = x.shape[0]
+        if self.attn_chunk_size > 0:
+            return min(self.attn_chunk_size, batch)
+        if self.attn_chunk_memory_mb > 0:
+            # estimate bytes per sequence: attention weights (heads x f x n) + q, k, v, and attn out (f x inner_dim)
+            seq_len = x.shape[1]
+            context_len = context.shape[1] if context is not None else seq_len
+            inner_dim = self.heads * self.dim_head
+            itemsize = x.element_size()
+            per_sequence = self.heads * seq_len * context_len * itemsize + 4 * seq_len * inner_dim * itemsize
+            return max(1, min(batch, (self.attn_chunk_memory_mb * 1024 * 1024) // per_sequence))
+        return batch
+
+    def forward(self, x, context=None, value=None, mask=None):
+        # masks are not sliced along the batch, so only chunk when there is none
+        if mask is None and (self.attn_chunk_size > 0 or self.attn_chunk_memory_mb > 0):
+            chunk_size = self.get_attn_chunk_size(x, context)
+            if chunk_size < x.shape[0]:
+                return self.forward_chunked(x, context, value, chunk_size)
+        return self.forward_attention(x, context, value, mask)
+
+    def forward_chunked(self, x: Tensor, context: Tensor, value: Tensor, chunk_size: int) -> Tensor:
+        out = None
+        for start in range(0, x.shape[0], chunk_size):
+            end = min(start + chunk_size, x.shape[0])
+            chunk_out = self.forward_attention(
+                x[start:end],
+                context[start:end] if context is not None else None,
+                value[start:end] if value is not None else None,
+            )
+            # preallocate output once, now that its dtype and last dim are known
+            if out is None:
+                out = torch.empty((x.shape[0],) + chunk_out.shape[1:], dtype=chunk_out.dtype, device=chunk_out.device)
+            out[start:end] = chunk_out
+            del chunk_out
+        return out
+
+    def forward_attention(self, x, context=None, value=None, mask=None):
+        if self.to_qkv is not None and context is None and value is None:
+            q, k, v = self.to_qkv(x).chunk(3, dim=-1)
+        else:
+            q = self.to_q(x)
+            context = default(context, x)
+            k = self.to_k(context)
+            if value is not None:
+                v = self.to_v(value)
+                del value
+            else:
+                v = self.to_v(context)
+        attention = None
+        if self.autotune_attention and mask is None:
+            attention = attention_autotuner.get_attention(q, k, v, self.heads)
+        if attention is None:
+            attention = optimized_attention_mm
+        out = attention(q, k, v, self.heads, mask)
         return self.to_out(out)
 
 
+# limits amount of shape buckets compiled per module, to bound recompilation time and memory
+MAX_COMPILED_BUCKETS = 8
+
+
+def is_compile_available() -> bool:
+    return hasattr(torch, "compile")
+
+
+class CompiledForward:
+    # torch.compile'd version of a forward function, tracked per shape bucket; falls back to eager
+    # on buckets that failed to compile or that go beyond the bucket limit
+    def __init__(self, forward: Callable):
+        self.forward = forward
+        self.compiled: Callable = None
+        self.buckets: set[tuple] = set()
+        self.failed_buckets: set[tuple] = set()
+
+    def __call__(self, bucket: tuple, *args, **kwargs):
+        if bucket in self.failed_buckets or (bucket not in self.buckets and len(self.buckets) >= MAX_COMPILED_BUCKETS):
+            return self.forward(*args, **kwargs)
+        try:
+            if self.compiled is None:
+                self.compiled = torch.compile(self.forward)
+            out = self.compiled(*args, **kwargs)
+            self.buckets.add(bucket)
+            return out
+        except Exception as e:
+            logger.warning(f"Could not use compiled motion module for shape bucket {bucket}, falling back to eager: {e}")
+            self.failed_buckets.add(bucket)
+            return self.forward(*args, **kwargs)
+
+
 class BlockType:
     UP = "up"
     DOWN = "down"
@@ -83,7 +333,10 @@ class GenericMotionWrapper(nn.Module, ABC):
         self.version = "FILLTHISIN"
         self.injector_version = "VERYIMPORTANT_FILLTHISIN"
         self.AD_video_length: int = 0
+        self.scale_multiplier: Union[float, None] = None
         self.loras = loras
+        # original values of weights patched in place (e.g. by motion LoRAs), to be restored after sampling
+        self.weight_backups: dict[str, tuple[Tensor, ...]] = {}
 
     def has_loras(self) -> bool:
         # TODO: fix this to return False if has an empty list as well
@@ -105,6 +358,117 @@ class GenericMotionWrapper(nn.Module, ABC):
     def set_sub_idxs(self, sub_idxs: list[int]):
         pass
 
+    def set_attn_chunking(self, chunk_size: int=0, memory_mb: int=0):
+        for module in self.modules():
+            if isinstance(module, CrossAttentionMM):
+                module.set_attn_chunking(chunk_size, memory_mb)
+
+    def reset_attn_chunking(self):
+        self.set_attn_chunking(0, 0)
+
+    def add_weight_patch(self, key: str, delta: Tensor):
+        # add delta to weight in place, keeping a backup of the original value the first time key is patched
+        module_path, attr = key.rsplit(".", 1)
+        module = self.get_submodule(module_path)
+        with torch.no_grad():
+            if isinstance(module, Int8Linear) and attr == "weight":
+                if key not in self.weight_backups:
+                    self.weight_backups[key] = (module.weight_int8.clone(), module.weight_scale.clone())
+                module.set_weight(module.dequantize_weight(torch.float32) + delta.to(device=module.weight_int8.device, dtype=torch.float32))
+            else:
+                weight: Tensor = getattr(module, attr)
+                if key not in self.weight_backups:
+                    self.weight_backups[key] = (weight.detach().clone(),)
+                weight.copy_(weight.float() + delta.to(device=weight.device, dtype=torch.float32))
+
+    def restore_weight_patches(self):
+        with torch.no_grad():
+            for key, backup in self.weight_backups.items():
+                module_path, attr = key.rsplit(".", 1)
+                module = self.get_submodule(module_path)
+                if isinstance(module, Int8Linear) and attr == "weight":
+                    module.weight_int8.copy_(backup[0])
+                    module.weight_scale.copy_(backup[1])
+                else:
+                    getattr(module, attr).copy_(backup[0])
+        self.weight_backups.clear()
+
+    def get_temporal_modules_by_depth(self) -> list[tuple[str, nn.Module]]:
+        # depths are named by block type and index within that type, e.g. "down0", "mid", "up3"
+        modules = []
+        for i, block in enumerate(self.down_blocks):
+            modules.extend((f"{BlockType.DOWN}{i}", module) for module in block.get_temporal_modules())
+        if self.mid_block is not None:
+            modules.extend((BlockType.MID, module) for module in self.mid_block.get_temporal_modules())
+        for i, block in enumerate(self.up_blocks):
+            modules.extend((f"{BlockType.UP}{i}", module) for module in block.get_temporal_modules())
+        return modules
+
+    def set_motion_cache(self, options: Union[MotionCacheOptions, None]) -> int:
+        # give each temporal module to cache a unique id; returns amount of cached modules
+        cached_count = 0
+        for i, (depth, module) in enumerate(self.get_temporal_modules_by_depth()):
+            if options is not None and options.is_depth_cached(depth):
+                module.motion_cache_id = i
+                cached_count += 1
+            else:
+                module.motion_cache_id = None
+        return cached_count
+
+    def get_int8_excluded_types(self) -> tuple[type, ...]:
+        # module types that are never quantized nor searched for Linear layers; subclasses add their own
+        return (nn.LayerNorm, nn.GroupNorm)
+
+    def quantize_int8(self):
+        # replace Linear layers in temporal transformers with weight-only int8 versions, and report accuracy
+        report: list[tuple[str, str, float]] = []
+        skipped: list[tuple[str, str]] = []
+        size_before = sum(t.numel() * t.element_size() for t in self.state_dict().values())
+        count = quantize_linears_int8(self, report, excluded_types=self.get_int8_excluded_types(), skipped=skipped)
+        size_after = sum(t.numel() * t.element_size() for t in self.state_dict().values())
+        if len(skipped) > 0:
+            logger.warning(f"Left {len(skipped)} layers of motion module {self.mm_name} unquantized, since they hold 2D weights but are not Linear: " +
+                           ", ".join(f"{name} ({type_name})" for name, type_name in skipped))
+        if count == 0:
+            return
+        errors = [error for _, _, error in report]
+        worst_name, _, worst_error = max(report, key=lambda x: x[2])
+        type_counts: dict[str, int] = {}
+        for _, type_name, _ in report:
+            type_counts[type_name] = type_counts.get(type_name, 0) + 1
+        type_counts_str = ", ".join(f"{type_name}: {type_count}" for type_name, type_count in sorted(type_counts.items()))
+        logger.info(f"Quantized {count} Linear layers of motion module {self.mm_name} to int8 [{type_counts_str}] " +
+                    f"({size_before / 2**20:.1f}MB -> {size_after / 2**20:.1f}MB); relative output error vs. original " +
+                    f"weights on fixed inputs: mean {sum(errors) / len(errors):.4%}, worst {worst_error:.4%} ({worst_name}).")
+
+    def set_compiled(self, compiled: bool) -> bool:
+        if compiled and not is_compile_available():
+            logger.warning("torch.compile is not available in this version of torch; motion module will run eagerly.")
+            compiled = False
+        blocks = list(self.down_blocks) + list(self.up_blocks) + ([self.mid_block] if self.mid_block is not None else [])
+        if compiled:
+            import torch._dynamo
+            # temporal transformers share forward code, so dynamo's per-code cache must fit all modules and buckets
+            temporal_count = len(self.get_temporal_modules_by_depth())
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, temporal_count * MAX_COMPILED_BUCKETS)
+        for block in blocks:
+            block.set_compiled(compiled)
+        return compiled
+
+    def set_attention_autotune(self, autotune: bool):
+        for module in self.modules():
+            if isinstance(module, CrossAttentionMM):
+                module.autotune_attention = autotune
+
+    def set_fused_qkv(self, fuse: bool):
+        # collect first, since fusing modifies submodules
+        attention_modules = [module for module in self.modules() if isinstance(module, CrossAttentionMM)]
+        for module in attention_modules:
+            if fuse:
+                module.fuse_qkv()
+            else:
+                module.unfuse_qkv()
+
 
 class GroupNormAD(torch.nn.GroupNorm):
     def __init__(self, num_groups: int, num_channels: int, eps: float = 1e-5, affine: bool = True,
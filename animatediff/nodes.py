@@ -9,18 +9,21 @@ import torch
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
+import comfy.model_management as model_management
 import comfy.sample as comfy_sample
 import folder_paths
 import nodes as comfy_nodes
 from comfy.model_patcher import ModelPatcher
 from comfy.sd import load_checkpoint_guess_config
-from .context import ContextOptions, ContextSchedules, UniformContextOptions
+from .context import ContextOptions, ContextSchedules, UniformContextOptions, simulate_context_schedule
 from .logger import logger
 from .model_utils import IsChangedHelper, get_available_motion_loras, get_available_motion_models, BetaSchedules, \
     raise_if_not_checkpoint_sd1_5
+from .motion_cache import MotionCacheOptions
 from .motion_lora import MotionLoRAInfo, MotionLoRAList
 from .motion_module import InjectorVersion, InjectionParams, MotionModelSettings
-from .motion_module import eject_params_from_model, inject_params_into_model, load_motion_lora, load_motion_module
+from .motion_module import eject_params_from_model, inject_params_into_model, load_motion_lora, load_motion_loras, \
+    load_motion_module
 from .sampling import animatediff_sample_factory
 
 # override comfy_sample.sample with animatediff-support version
@@ -92,6 +95,10 @@ class AnimateDiffModelSettingsAdvanced:
                 "initial_pe_idx_offset": ("INT", {"default": 0, "min": 0, "step": 1}),
                 "final_pe_idx_offset": ("INT", {"default": 0, "min": 0, "step": 1}),
             },
+            "optional": {
+                "attn_chunk_size": ("INT", {"default": 0, "min": 0, "step": 1}),
+                "attn_chunk_memory_mb": ("INT", {"default": 0, "min": 0, "step": 64}),
+            }
         }
     
     RETURN_TYPES = ("MOTION_MODEL_SETTINGS",)
@@ -101,7 +108,8 @@ class AnimateDiffModelSettingsAdvanced:
     def get_motion_model_settings(self, pe_strength: float, attn_strength: float, other_strength: float,
                                   motion_pe_stretch: int,
                                   cap_initial_pe_length: int, interpolate_pe_to_length: int,
-                                  initial_pe_idx_offset: int, final_pe_idx_offset: int):
+                                  initial_pe_idx_offset: int, final_pe_idx_offset: int,
+                                  attn_chunk_size: int=0, attn_chunk_memory_mb: int=0):
         motion_model_settings = MotionModelSettings(
             pe_strength=pe_strength,
             attn_strength=attn_strength,
@@ -110,7 +118,9 @@ class AnimateDiffModelSettingsAdvanced:
             interpolate_pe_to_length=interpolate_pe_to_length,
             initial_pe_idx_offset=initial_pe_idx_offset,
             final_pe_idx_offset=final_pe_idx_offset,
-            motion_pe_stretch=motion_pe_stretch
+            motion_pe_stretch=motion_pe_stretch,
+            attn_chunk_size=attn_chunk_size,
+            attn_chunk_memory_mb=attn_chunk_memory_mb,
             )
 
         return (motion_model_settings,)
@@ -135,6 +145,10 @@ class AnimateDiffModelSettingsAdvancedAttnStrengths:
                 "initial_pe_idx_offset": ("INT", {"default": 0, "min": 0, "step": 1}),
                 "final_pe_idx_offset": ("INT", {"default": 0, "min": 0, "step": 1}),
             },
+            "optional": {
+                "attn_chunk_size": ("INT", {"default": 0, "min": 0, "step": 1}),
+                "attn_chunk_memory_mb": ("INT", {"default": 0, "min": 0, "step": 64}),
+            }
         }
     
     RETURN_TYPES = ("MOTION_MODEL_SETTINGS",)
@@ -150,7 +164,8 @@ class AnimateDiffModelSettingsAdvancedAttnStrengths:
                                   other_strength: float,
                                   motion_pe_stretch: int,
                                   cap_initial_pe_length: int, interpolate_pe_to_length: int,
-                                  initial_pe_idx_offset: int, final_pe_idx_offset: int):
+                                  initial_pe_idx_offset: int, final_pe_idx_offset: int,
+                                  attn_chunk_size: int=0, attn_chunk_memory_mb: int=0):
         motion_model_settings = MotionModelSettings(
             pe_strength=pe_strength,
             attn_strength=attn_strength,
@@ -164,7 +179,9 @@ class AnimateDiffModelSettingsAdvancedAttnStrengths:
             interpolate_pe_to_length=interpolate_pe_to_length,
             initial_pe_idx_offset=initial_pe_idx_offset,
             final_pe_idx_offset=final_pe_idx_offset,
-            motion_pe_stretch=motion_pe_stretch
+            motion_pe_stretch=motion_pe_stretch,
+            attn_chunk_size=attn_chunk_size,
+            attn_chunk_memory_mb=attn_chunk_memory_mb,
             )
 
         return (motion_model_settings,)
@@ -186,6 +203,13 @@ class AnimateDiffLoaderWithContext:
                 "motion_model_settings": ("MOTION_MODEL_SETTINGS",),
                 "motion_scale": ("FLOAT", {"default": 1.0, "min": 0.0, "step": 0.001}),
                 "apply_v2_models_properly": ("BOOLEAN", {"default": False}),
+                "fuse_qkv": ("BOOLEAN", {"default": False}),
+                "autotune_attention": ("BOOLEAN", {"default": False}),
+                "motion_cache_options": ("MOTION_CACHE_OPTIONS",),
+                "start_percent": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                "end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                "torch_compile": ("BOOLEAN", {"default": False}),
+                "quantize_int8": ("BOOLEAN", {"default": False}),
             }
         }
     
@@ -198,10 +222,16 @@ class AnimateDiffLoaderWithContext:
         model: ModelPatcher,
         model_name: str, beta_schedule: str,# apply_mm_groupnorm_hack: bool,
         context_options: ContextOptions=None, motion_lora: MotionLoRAList=None, motion_model_settings: MotionModelSettings=None,
-        motion_scale: float=1.0, apply_v2_models_properly: bool=False,
+        motion_scale: float=1.0, apply_v2_models_properly: bool=False, fuse_qkv: bool=False,
+        autotune_attention: bool=False, motion_cache_options: MotionCacheOptions=None,
+        start_percent: float=0.0, end_percent: float=1.0, torch_compile: bool=False, quantize_int8: bool=False,
     ):
         # load motion module
-        mm = load_motion_module(model_name, motion_lora, model=model, motion_model_settings=motion_model_settings)
+        mm = load_motion_module(model_name, model=model, motion_model_settings=motion_model_settings,
+                                quantize_int8=quantize_int8)
+        # load motion LoRAs now so that missing files are reported early; they are patched in at sampling time
+        if motion_lora is not None:
+            load_motion_loras(motion_lora)
         # set injection params
         injection_params = InjectionParams(
                 video_length=None,
@@ -211,6 +241,12 @@ class AnimateDiffLoaderWithContext:
                 injector=mm.injector_version,
                 model_name=model_name,
                 apply_v2_models_properly=apply_v2_models_properly,
+                fuse_qkv=fuse_qkv,
+                autotune_attention=autotune_attention,
+                start_percent=start_percent,
+                end_percent=end_percent,
+                torch_compile=torch_compile,
+                quantize_int8=quantize_int8,
         )
         if context_options:
             # set context settings TODO: make this dynamic for future purposes
@@ -221,10 +257,14 @@ class AnimateDiffLoaderWithContext:
                         context_overlap=context_options.context_overlap,
                         context_schedule=context_options.context_schedule,
                         closed_loop=context_options.closed_loop,
-                        sync_context_to_pe=context_options.sync_context_to_pe
+                        sync_context_to_pe=context_options.sync_context_to_pe,
+                        batch_windows=context_options.batch_windows,
+                        min_coverage=context_options.min_coverage,
                 )
         if motion_lora:
             injection_params.set_loras(motion_lora)
+        if motion_cache_options:
+            injection_params.set_motion_cache_options(motion_cache_options)
         # set motion_scale and motion_model_settings
         if not motion_model_settings:
             motion_model_settings = MotionModelSettings()
@@ -248,24 +288,60 @@ class AnimateDiffUniformContextOptions:
                 "closed_loop": ("BOOLEAN", {"default": False},),
                 #"sync_context_to_pe": ("BOOLEAN", {"default": False},),
             },
+            "optional": {
+                "batch_windows": ("BOOLEAN", {"default": False},),
+                "min_coverage": ("INT", {"default": 1, "min": 1, "max": 32}), # only used by uniform coverage
+            }
         }
     
     RETURN_TYPES = ("CONTEXT_OPTIONS",)
     CATEGORY = "Animate Diff 🎭🅐🅓"
     FUNCTION = "create_options"
 
-    def create_options(self, context_length: int, context_stride: int, context_overlap: int, context_schedule: int, closed_loop: bool):
+    def create_options(self, context_length: int, context_stride: int, context_overlap: int, context_schedule: int, closed_loop: bool,
+                       batch_windows: bool=False, min_coverage: int=1):
         context_options = UniformContextOptions(
             context_length=context_length,
             context_stride=context_stride,
             context_overlap=context_overlap,
             context_schedule=context_schedule,
-            closed_loop=closed_loop
+            closed_loop=closed_loop,
+            batch_windows=batch_windows,
+            min_coverage=min_coverage,
             )
         #context_options.set_sync_context_to_pe(sync_context_to_pe)
         return (context_options,)
 
 
+class AnimateDiffMotionCacheOptions:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "refresh_steps": ("INT", {"default": 1, "min": 1, "max": 100}),
+                "sigma_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 100.0, "step": 0.01}),
+                "cache_depths": ("STRING", {"default": ""}),
+                "memory_budget_mb": ("FLOAT", {"default": 2048.0, "min": 0.0, "max": 1048576.0, "step": 64.0,
+                                               "tooltip": "Max MB of stored motion module outputs; caching turns off for the run if exceeded (0 = no limit). " +
+                                               "Costs roughly 48MB per latent frame at 512x512 with cond+uncond and a v2 motion model, scaling with resolution. " +
+                                               "With sliding context, outputs are kept in RAM and moved to the GPU per window."}),
+            },
+        }
+
+    RETURN_TYPES = ("MOTION_CACHE_OPTIONS",)
+    CATEGORY = "Animate Diff 🎭🅐🅓/motion settings"
+    FUNCTION = "create_options"
+
+    def create_options(self, refresh_steps: int, sigma_threshold: float, cache_depths: str, memory_budget_mb: float=2048.0):
+        motion_cache_options = MotionCacheOptions(
+            refresh_steps=refresh_steps,
+            sigma_threshold=sigma_threshold,
+            cache_depths=cache_depths,
+            memory_budget_mb=memory_budget_mb,
+            )
+        return (motion_cache_options,)
+
+
 
 class AnimateDiffLoader_Deprecated:
     @classmethod
@@ -519,6 +595,33 @@ class AnimateDiffCombine_Deprecated:
         ]
         return {"ui": {"gifs": previews}}
 
+class AnimateDiffContextScheduleReport:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "video_length": ("INT", {"default": 16, "min": 1, "max": 262144}),
+                "steps": ("INT", {"default": 20, "min": 1, "max": 10000}),
+                "width": ("INT", {"default": 512, "min": 64, "max": comfy_nodes.MAX_RESOLUTION, "step": 8}),
+                "height": ("INT", {"default": 512, "min": 64, "max": comfy_nodes.MAX_RESOLUTION, "step": 8}),
+            },
+            "optional": {
+                "context_options": ("CONTEXT_OPTIONS",),
+            }
+        }
+
+    RETURN_TYPES = ("STRING",)
+    CATEGORY = "Animate Diff 🎭🅐🅓/extras"
+    FUNCTION = "get_report"
+
+    def get_report(self, video_length: int, steps: int, width: int, height: int, context_options: ContextOptions=None):
+        report = simulate_context_schedule(video_length=video_length, num_steps=steps, context_options=context_options,
+                                           width=width, height=height, max_batch_area=model_management.maximum_batch_area())
+        report_str = report.to_string()
+        logger.info(f"Context schedule report:\n{report_str}")
+        return (report_str,)
+
+
 class CheckpointLoaderSimpleWithNoiseSelect:
     @classmethod
     def INPUT_TYPES(s):
@@ -569,6 +672,8 @@ NODE_CLASS_MAPPINGS = {
     "ADE_AnimateDiffModelSettingsAdvancedAttnStrengths": AnimateDiffModelSettingsAdvancedAttnStrengths,
     "ADE_AnimateDiffUnload": AnimateDiffUnload,
     "ADE_EmptyLatentImageLarge": EmptyLatentImageLarge,
+    "ADE_ContextScheduleReport": AnimateDiffContextScheduleReport,
+    "ADE_AnimateDiffMotionCacheOptions": AnimateDiffMotionCacheOptions,
     "CheckpointLoaderSimpleWithNoiseSelect": CheckpointLoaderSimpleWithNoiseSelect,
     "AnimateDiffLoaderV1": AnimateDiffLoader_Deprecated,
     "ADE_AnimateDiffLoaderV1Advanced": AnimateDiffLoaderAdvanced_Deprecated,
@@ -583,6 +688,8 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "ADE_AnimateDiffModelSettingsAdvancedAttnStrengths": "Motion Model Settings (Adv. Attn) 🎭🅐🅓",
     "ADE_AnimateDiffUnload": "AnimateDiff Unload 🎭🅐🅓",
     "ADE_EmptyLatentImageLarge": "Empty Latent Image (Big Batch) 🎭🅐🅓",
+    "ADE_ContextScheduleReport": "Context Schedule Report 🎭🅐🅓",
+    "ADE_AnimateDiffMotionCacheOptions": "Motion Cache Options 🎭🅐🅓",
     "CheckpointLoaderSimpleWithNoiseSelect": "Load Checkpoint w/ Noise Select 🎭🅐🅓",
     "AnimateDiffLoaderV1": "AnimateDiff Loader [DEPRECATED] 🎭🅐🅓",
     "ADE_AnimateDiffLoaderV1Advanced": "AnimateDiff Loader (Advanced) [DEPRECATED] 🎭🅐🅓",
@@ -1,6 +1,9 @@
+import contextvars
 import math
 import sys
-from typing import Callable
+import threading
+from collections import OrderedDict
+from typing import Callable, Union
 
 import torch
 from einops import rearrange
@@ -13,24 +16,64 @@ import comfy.samplers as comfy_samplers
 from comfy.controlnet import ControlBase
 from comfy.ldm.modules.attention import SpatialTransformer
 from comfy.model_patcher import ModelPatcher
-from .context import get_context_scheduler
+from .context import ContextPlan, ContextWindow, get_context_plan, get_windows_per_batch
+from .logger import logger
+from .motion_cache import MOTION_CACHE_KEY, MotionCacheCall, MotionCacheState
 from .model_utils import BetaScheduleCache, BetaSchedules, wrap_function_to_inject_xformers_bug_info
-from .motion_module import InjectionParams, eject_motion_module, inject_motion_module, inject_params_into_model, \
-    load_motion_module, unload_motion_module
+from .motion_module import InjectionParams, apply_motion_loras, eject_motion_module, inject_motion_module, \
+    inject_params_into_model, load_motion_loras, load_motion_module, pin_motion_module, unpin_motion_module
 from .motion_module import is_injected_mm_params, get_injected_mm_params
 from .motion_module_ad import AnimDiffMotionWrapper, VanillaTemporalModule
+from .motion_module_hsxl import TransformerTemporal
 from .motion_utils import GenericMotionWrapper, GroupNormAD
 
 
 ##################################################################################
 ######################################################################
-# Global variable to use to more conveniently hack variable access into samplers
-class AnimateDiffHelper_GlobalState:
+# Preallocated buffers reused across sampling steps, to avoid reallocating accumulators every step.
+# Buffers are only used internally; anything returned to the sampler must be a fresh tensor, since buffers get overwritten
+class WorkspacePool:
+    def __init__(self):
+        self.buffers: dict[tuple, Tensor] = {}
+        self.allocations = 0
+        self.allocations_avoided = 0
+
+    def get(self, name: str, shape: tuple, device: torch.device, dtype: torch.dtype, fill_value: Union[float, None]) -> Tensor:
+        key = (name, tuple(shape), device, dtype)
+        buffer = self.buffers.get(key, None)
+        if buffer is None:
+            buffer = torch.empty(shape, device=device, dtype=dtype)
+            self.buffers[key] = buffer
+            self.allocations += 1
+        else:
+            self.allocations_avoided += 1
+        if fill_value is None:
+            return buffer
+        return buffer.fill_(fill_value)
+
+    def get_like(self, name: str, tensor: Tensor, fill_value: float) -> Tensor:
+        return self.get(name, tensor.shape, tensor.device, tensor.dtype, fill_value)
+
+    def clear(self):
+        self.buffers.clear()
+
+
+# max amount of resized conds kept per run; covers cond and uncond of the windows of a typical step
+RESIZED_COND_CACHE_SIZE = 32
+
+
+# State of a single AnimateDiff sampling run; looked up by patched functions through a context variable,
+# so that runs in different threads (or contexts) do not share state
+class AnimateDiffRunState:
     def __init__(self):
         self.motion_module: GenericMotionWrapper = None
+        self.params: InjectionParams = None
         self.reset()
     
     def reset(self):
+        self.unlimited_area_hack: bool = False
+        self.groupnorm_hack: bool = False
+        self.groupnormad_hack: bool = False
         self.start_step: int = 0
         self.last_step: int = 0
         self.current_step: int = 0
@@ -42,12 +85,27 @@ class AnimateDiffHelper_GlobalState:
         self.context_schedule: str = None
         self.closed_loop: bool = False
         self.sync_context_to_pe: bool = False
+        self.batch_windows: bool = False
+        self.min_coverage: int = 1
         self.sub_idxs: list = None
+        self.context_plan: ContextPlan = None
+        # (cond type, axes_factor, window key) -> (original cond, resized cond); LRU limited to RESIZED_COND_CACHE_SIZE
+        self.resized_cond_cache: OrderedDict[tuple, tuple[list, list]] = OrderedDict()
+        self.feather_mult_cache: dict[tuple, Tensor] = {}
+        self.workspace = WorkspacePool()
+        self.motion_cache: MotionCacheState = None
+        # absolute idxs of latent frames of the context window(s) currently being run, used by the motion cache
+        self.current_full_idxs: list[int] = None
+        self.current_full_length: int = None
+        self.start_percent: float = 0.0
+        self.end_percent: float = 1.0
+        self.motion_active: bool = True
         if self.motion_module is not None:
             del self.motion_module
             self.motion_module = None
     
     def update_with_inject_params(self, params: InjectionParams):
+        self.params = params
         self.video_length = params.video_length
         self.context_frames = params.context_length
         self.context_stride = params.context_stride
@@ -55,25 +113,109 @@ class AnimateDiffHelper_GlobalState:
         self.context_schedule = params.context_schedule
         self.closed_loop = params.closed_loop
         self.sync_context_to_pe = params.sync_context_to_pe
+        self.batch_windows = params.batch_windows
+        self.min_coverage = params.min_coverage
+        self.start_percent = params.start_percent
+        self.end_percent = params.end_percent
+
+    def update_motion_active(self):
+        # motion modules get bypassed outside of start/end percent of steps; if total steps unknown, always run
+        if self.total_steps <= 0 or (self.start_percent <= 0.0 and self.end_percent >= 1.0):
+            self.motion_active = True
+            return
+        step_percent = self.current_step / self.total_steps
+        self.motion_active = self.start_percent <= step_percent < self.end_percent
+
+    def prepare_context_plan(self):
+        if self.is_using_sliding_context():
+            self.context_plan = get_context_plan(self.context_schedule, self.total_steps, self.video_length, self.context_frames,
+                                                 self.context_stride, self.context_overlap, self.closed_loop, self.min_coverage)
 
     def is_using_sliding_context(self):
         return self.context_frames is not None
 
-ADGS = AnimateDiffHelper_GlobalState()
+ad_run_state: contextvars.ContextVar[AnimateDiffRunState] = contextvars.ContextVar("ad_run_state", default=None)
+
+
+def get_run_state() -> Union[AnimateDiffRunState, None]:
+    return ad_run_state.get()
+
+
+class KeyedLocks:
+    # one lock per key, created on first use
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks: dict[tuple, threading.RLock] = {}
+
+    def get(self, key: tuple) -> threading.RLock:
+        with self.lock:
+            lock = self.locks.get(key, None)
+            if lock is None:
+                lock = threading.RLock()
+                self.locks[key] = lock
+            return lock
+
+
+# runs modify the shared diffusion model (motion module injection, beta schedule) and the shared cached motion module
+# (LoRA patches, scale, fused qkv, chunking, compile, motion cache, video length), so runs sharing either are serialized;
+# model lock is always acquired before motion module lock, so runs cannot deadlock
+run_locks = KeyedLocks()
 ######################################################################
 ##################################################################################
 
 
 ##################################################################################
 #### Code Injection ##################################################
-def forward_timestep_embed(
-    ts, x, emb, context=None, transformer_options={}, output_shape=None
-):
+# Original functions, saved when patches are installed
+orig_forward_timestep_embed: Callable = None
+orig_maximum_batch_area: Callable = None
+orig_groupnorm_forward: Callable = None
+orig_groupnormad_forward: Callable = None
+orig_sampling_function: Callable = None
+
+patches_lock = threading.Lock()
+patches_installed = False
+
+
+def install_sampling_patches():
+    # patches are installed once, on the first AnimateDiff run, and left in place for the rest of the process, so they also see
+    # non-AnimateDiff workflows. Each patched function must therefore check get_run_state() first and, when it is None,
+    # call the original with the exact arguments it received
+    global orig_forward_timestep_embed, orig_maximum_batch_area, orig_groupnorm_forward, orig_groupnormad_forward, \
+        orig_sampling_function, patches_installed
+    with patches_lock:
+        if patches_installed:
+            return
+        orig_forward_timestep_embed = openaimodel.forward_timestep_embed # needed to account for VanillaTemporalModule
+        orig_maximum_batch_area = model_management.maximum_batch_area # allows for "unlimited area hack" to prevent halving of conds/unconds
+        orig_groupnorm_forward = torch.nn.GroupNorm.forward # used to normalize latents to remove "flickering" of colors/brightness between frames
+        orig_groupnormad_forward = GroupNormAD.forward
+        orig_sampling_function = comfy_samplers.sampling_function # used to support sliding context windows in samplers
+
+        openaimodel.forward_timestep_embed = forward_timestep_embed
+        model_management.maximum_batch_area = maximum_batch_area
+        torch.nn.GroupNorm.forward = groupnorm_mm_factory(orig_groupnorm_forward, "groupnorm_hack")
+        GroupNormAD.forward = groupnorm_mm_factory(orig_groupnormad_forward, "groupnormad_hack")
+        comfy_samplers.sampling_function = sampling_function
+        patches_installed = True
+
+
+def forward_timestep_embed(ts, x, emb, *args, **kwargs):
+    run_state = get_run_state()
+    if run_state is None:
+        return orig_forward_timestep_embed(ts, x, emb, *args, **kwargs)
+    return ad_forward_timestep_embed(run_state, ts, x, emb, *args, **kwargs)
+
+def ad_forward_timestep_embed(run_state: AnimateDiffRunState, ts, x, emb, context=None, transformer_options={}, output_shape=None,
+                              *args, **kwargs):
+    # arguments added by newer ComfyUI versions (e.g. time_context) are not used by SD1.5/SDXL UNets with motion modules
     for layer in ts:
         if isinstance(layer, openaimodel.TimestepBlock):
             x = layer(x, emb)
         elif isinstance(layer, VanillaTemporalModule):
-            x = layer(x, context)
+            x = temporal_module_forward(run_state, layer, x, context, transformer_options)
+        elif isinstance(layer, TransformerTemporal):
+            x = temporal_module_forward(run_state, layer, x, None, transformer_options)
         elif isinstance(layer, SpatialTransformer):
             x = layer(x, context, transformer_options)
             transformer_options["current_index"] += 1
@@ -83,15 +225,93 @@ def forward_timestep_embed(
             x = layer(x)
     return x
 
-def unlimited_batch_area():
-    return int(sys.maxsize)
-
-
-def groupnorm_mm_factory(params: InjectionParams):
-    def groupnorm_mm_forward(self, input: Tensor) -> Tensor:
+def temporal_module_forward(run_state: AnimateDiffRunState, layer: Union[VanillaTemporalModule, TransformerTemporal], x: Tensor,
+                            context: Tensor, transformer_options: dict):
+    # outside of motion step range, temporal modules act as identity
+    if not run_state.motion_active:
+        return x
+    if run_state.motion_cache is not None and layer.motion_cache_id is not None:
+        return run_state.motion_cache.forward(layer, x, context, transformer_options.get(MOTION_CACHE_KEY, None))
+    return layer(x, context)
+
+def maximum_batch_area(*args, **kwargs):
+    run_state = get_run_state()
+    if run_state is not None and run_state.unlimited_area_hack:
+        return int(sys.maxsize)
+    return orig_maximum_batch_area(*args, **kwargs)
+
+
+def get_window_batch_area() -> Union[int, None]:
+    # batch area used to stack context windows; always the unpatched value, so unlimited_area_hack cannot stack every window.
+    # Returns None if it cannot be determined (e.g. free memory unavailable on the device)
+    try:
+        return (orig_maximum_batch_area or model_management.maximum_batch_area)()
+    except Exception:
+        return None
+
+
+def sampling_function(*args, **kwargs):
+    if get_run_state() is None:
+        return orig_sampling_function(*args, **kwargs)
+    return sliding_sampling_function(*args, **kwargs)
+
+
+def get_area_feather_mult(run_state: AnimateDiffRunState, x_in: Tensor, area: tuple, strength: float, rr: int=8) -> Tensor:
+    key = (x_in.shape[2], x_in.shape[3], tuple(area), strength, x_in.device, x_in.dtype)
+    mult = run_state.feather_mult_cache.get(key, None)
+    if mult is not None:
+        return mult
+    # feather edges of area that do not touch the latent's borders with a linear ramp of width rr
+    ramp = torch.arange(1, rr + 1, dtype=torch.float32) / rr
+    def get_edge_mult(length: int, feather_start: bool, feather_end: bool) -> Tensor:
+        edge_mult = torch.ones(length, dtype=torch.float32)
+        n = min(rr, length)
+        if feather_start:
+            edge_mult[:n] *= ramp[:n]
+        if feather_end:
+            edge_mult[length-n:] *= ramp[:n].flip(0)
+        return edge_mult
+    rows = get_edge_mult(area[0], area[2] != 0, (area[0] + area[2]) < x_in.shape[2])
+    cols = get_edge_mult(area[1], area[3] != 0, (area[1] + area[3]) < x_in.shape[3])
+    mult = (rows[:, None] * cols[None, :] * strength).to(device=x_in.device, dtype=x_in.dtype)[None, None]
+    run_state.feather_mult_cache[key] = mult
+    return mult
+
+
+def get_window_input(tensor: Tensor, window: ContextWindow, axes_factor: int, video_length: int) -> Tensor:
+    # contiguous windows are returned as views; only wrapped/strided windows require a gather
+    if window.is_slice():
+        if axes_factor == 1:
+            return tensor[window.slice]
+        return tensor.view(axes_factor, video_length, *tensor.shape[1:])[:, window.slice].reshape(-1, *tensor.shape[1:])
+    return tensor.index_select(0, window.get_full_idxs_tensor(axes_factor, video_length, tensor.device))
+
+
+def add_window_output(tensor: Tensor, window: ContextWindow, axes_factor: int, video_length: int, value: Union[Tensor, float]):
+    # accumulate in place into a view for contiguous windows; otherwise scatter with index_add_
+    if window.is_slice():
+        if axes_factor == 1:
+            tensor[window.slice].add_(value)
+        else:
+            if isinstance(value, Tensor):
+                value = value.view(axes_factor, len(window), *value.shape[1:])
+            tensor.view(axes_factor, video_length, *tensor.shape[1:])[:, window.slice].add_(value)
+        return
+    full_idxs = window.get_full_idxs_tensor(axes_factor, video_length, tensor.device)
+    if not isinstance(value, Tensor):
+        value = torch.full((len(full_idxs), *tensor.shape[1:]), value, dtype=tensor.dtype, device=tensor.device)
+    tensor.index_add_(0, full_idxs, value)
+
+
+def groupnorm_mm_factory(orig_forward: Callable, hack_attr: str):
+    def groupnorm_mm_forward(self, input: Tensor, *args, **kwargs) -> Tensor:
+        run_state = get_run_state()
+        if run_state is None or not getattr(run_state, hack_attr):
+            return orig_forward(self, input, *args, **kwargs)
+        params = run_state.params
         # axes_factor normalizes batch based on total conds and unconds passed in batch;
         # the conds and unconds per batch can change based on VRAM optimizations that may kick in
-        if not ADGS.is_using_sliding_context():
+        if not run_state.is_using_sliding_context():
             axes_factor = input.size(0)//params.video_length
         else:
             axes_factor = input.size(0)//params.context_length
@@ -111,42 +331,45 @@ def animatediff_sample_factory(orig_comfy_sample: Callable) -> Callable:
         if not is_injected_mm_params(model):
             return orig_comfy_sample(model, *args, **kwargs)
         # otherwise, injection time
+        install_sampling_patches()
         motion_module = None
         orig_beta_cache = None
+        held_locks: list[threading.RLock] = []
+        # patched functions look up the state of the run active in the current context
+        run_state = AnimateDiffRunState()
+        run_state_token = ad_run_state.set(run_state)
         try:
+            # wait for other runs using the same diffusion model to finish
+            model_lock = run_locks.get(("model", id(model.model)))
+            model_lock.acquire()
+            held_locks.append(model_lock)
             # get params - clone to keep from resetting values on cached model
             params = get_injected_mm_params(model).clone()
             # get amount of latents passed in, and inject into model
             latents = args[-1]
             params.video_length = latents.size(0)
             model = inject_params_into_model(model, params)
-            # reset global state
-            ADGS.reset()
             ##############################################
-            # Save Original Functions
-            orig_forward_timestep_embed = openaimodel.forward_timestep_embed # needed to account for VanillaTemporalModule
-            orig_maximum_batch_area = model_management.maximum_batch_area # allows for "unlimited area hack" to prevent halving of conds/unconds
-            orig_groupnorm_forward = torch.nn.GroupNorm.forward # used to normalize latents to remove "flickering" of colors/brightness between frames
-            orig_groupnormad_forward = GroupNormAD.forward
-            orig_sampling_function = comfy_samplers.sampling_function # used to support sliding context windows in samplers
             # save original beta schedule settings
             orig_beta_cache = BetaScheduleCache(model)
             ##############################################
 
             # try to load motion module
-            motion_module = load_motion_module(params.model_name, params.loras, model=model, motion_model_settings=params.motion_model_settings)
+            motion_module = load_motion_module(params.model_name, model=model, motion_model_settings=params.motion_model_settings,
+                                               quantize_int8=params.quantize_int8)
+            # wait for other runs using the same motion module to finish
+            mm_lock = run_locks.get(("motion_module", motion_module.mm_hash))
+            mm_lock.acquire()
+            held_locks.append(mm_lock)
+            pin_motion_module(motion_module)
 
             ##############################################
-            # Inject Functions
-            openaimodel.forward_timestep_embed = forward_timestep_embed
-            if params.unlimited_area_hack:
-                model_management.maximum_batch_area = unlimited_batch_area
+            # Enable patched behavior for this run
+            run_state.unlimited_area_hack = params.unlimited_area_hack
             # only apply groupnorm hack if not v2 and should not apply v2 properly
             if not (isinstance(motion_module, AnimDiffMotionWrapper) and motion_module.version == "v2" and params.apply_v2_models_properly):
-                torch.nn.GroupNorm.forward = groupnorm_mm_factory(params)
-                if params.apply_mm_groupnorm_hack:
-                    GroupNormAD.forward = groupnorm_mm_factory(params)
-            comfy_samplers.sampling_function = sliding_sampling_function
+                run_state.groupnorm_hack = True
+                run_state.groupnormad_hack = params.apply_mm_groupnorm_hack
             ##############################################
 
             # inject motion module into unet
@@ -155,54 +378,102 @@ def animatediff_sample_factory(orig_comfy_sample: Callable) -> Callable:
             # apply suggested beta schedule (model_sampling)
             model.model.model_sampling = BetaSchedules.to_model_sampling(params.beta_schedule, model)
 
+            # patch in motion LoRAs, if present; must happen before weights are scaled or fused
+            if params.loras is not None:
+                apply_motion_loras(motion_module, load_motion_loras(params.loras))
+
             # apply scale multiplier, if needed
             motion_module.set_scale_multiplier(params.motion_model_settings.attn_scale)
 
-            # handle GLOBALSTATE vars and step tally
-            ADGS.motion_module = motion_module
-            ADGS.update_with_inject_params(params)
-            ADGS.start_step = kwargs.get("start_step") or 0
-            ADGS.current_step = ADGS.start_step
-            ADGS.last_step = kwargs.get("last_step") or 0
+            # fuse q, k, and v projections of temporal self-attention, if requested
+            if params.fuse_qkv:
+                motion_module.set_fused_qkv(True)
+
+            # run temporal transformers through torch.compile, if requested
+            compiled = False
+            if params.torch_compile:
+                compiled = motion_module.set_compiled(True)
+
+            # choose attention backends by timing them on actual shapes, if requested
+            if params.autotune_attention:
+                if compiled:
+                    # timing backends cannot happen while being traced by torch.compile
+                    logger.warning("autotune_attention is ignored when torch_compile is enabled.")
+                else:
+                    motion_module.set_attention_autotune(True)
+
+            # chunk temporal attention to cap peak memory, if requested
+            if params.motion_model_settings.has_attn_chunking():
+                motion_module.set_attn_chunking(params.motion_model_settings.attn_chunk_size,
+                                                params.motion_model_settings.attn_chunk_memory_mb)
+
+            # reuse temporal module outputs across steps, if requested
+            if params.motion_cache_options is not None and motion_module.set_motion_cache(params.motion_cache_options) > 0:
+                run_state.motion_cache = MotionCacheState(params.motion_cache_options, offload_device=model_management.unet_offload_device())
+
+            # handle run state vars and step tally
+            run_state.motion_module = motion_module
+            run_state.update_with_inject_params(params)
+            run_state.start_step = kwargs.get("start_step") or 0
+            run_state.current_step = run_state.start_step
+            run_state.last_step = kwargs.get("last_step") or 0
+            # steps is passed in positionally after noise
+            if len(args) > 1 and isinstance(args[1], int):
+                run_state.total_steps = args[1]
+            run_state.prepare_context_plan()
 
             original_callback = kwargs.get("callback", None)
             def ad_callback(step, x0, x, total_steps):
                 if original_callback is not None:
                     original_callback(step, x0, x, total_steps)
-                # update GLOBALSTATE for next iteration
-                ADGS.current_step = ADGS.start_step + step + 1
+                # update run state for next iteration
+                run_state.current_step = run_state.start_step + step + 1
             kwargs["callback"] = ad_callback
 
             return wrap_function_to_inject_xformers_bug_info(orig_comfy_sample)(model, *args, **kwargs)
         finally:
+            if run_state.workspace.allocations_avoided > 0:
+                logger.info(f"Workspace pool avoided {run_state.workspace.allocations_avoided} allocations ({run_state.workspace.allocations} buffers allocated).")
+            if run_state.motion_cache is not None:
+                run_state.motion_cache.log_hit_rate()
             # attempt to eject motion module
             eject_motion_module(model=model)
             if motion_module is not None:
+                # restore unfused q, k, and v projections
+                motion_module.set_fused_qkv(False)
+                # disable attention chunking and autotuning
+                motion_module.reset_attn_chunking()
+                motion_module.set_attention_autotune(False)
+                # stop caching temporal module outputs
+                motion_module.set_motion_cache(None)
+                # run eagerly unless compile is requested again; compiled graphs are kept on the modules
+                motion_module.set_compiled(False)
                 # reset motion module scale multiplier
                 motion_module.reset_scale_multiplier()
+                # remove motion LoRA patches, so cached weights are clean for the next run
+                motion_module.restore_weight_patches()
                 # reset motion module sub_idxs
                 motion_module.set_sub_idxs(None)
-                # if loras are present, remove model so it can be re-loaded next time with fresh weights
-                if motion_module.has_loras():
-                    unload_motion_module(motion_module)
-                    del motion_module
+                # allow motion module to be evicted from cache again
+                unpin_motion_module(motion_module)
             ##############################################
             # Restoration
-            model_management.maximum_batch_area = orig_maximum_batch_area
-            openaimodel.forward_timestep_embed = orig_forward_timestep_embed
-            torch.nn.GroupNorm.forward = orig_groupnorm_forward
-            GroupNormAD.forward = orig_groupnormad_forward
-            comfy_samplers.sampling_function = orig_sampling_function
             # reapply previous beta schedule
             if orig_beta_cache is not None:
                 orig_beta_cache.use_cached_beta_schedule_and_clean(model)
-            # reset global state
-            ADGS.reset()
+            # release run state, and stop patched functions from using it
+            run_state.reset()
+            ad_run_state.reset(run_state_token)
+            # allow other runs using the same model or motion module to proceed
+            for lock in reversed(held_locks):
+                lock.release()
             ##############################################
     return animatediff_sample
 
 
 def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_scale, model_options={}, seed=None):
+        run_state = get_run_state()
+
         def get_area_and_mult(conds, x_in, timestep_in):
             area = (x_in.shape[2], x_in.shape[3], 0, 0)
             strength = 1.0
@@ -232,24 +503,10 @@ def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_sc
                 assert(mask.shape[2] == x_in.shape[3])
                 mask = mask[:,area[2]:area[0] + area[2],area[3]:area[1] + area[3]] * mask_strength
                 mask = mask.unsqueeze(1).repeat(input_x.shape[0] // mask.shape[0], input_x.shape[1], 1, 1)
+                mult = mask * strength
             else:
-                mask = torch.ones_like(input_x)
-            mult = mask * strength
-
-            if 'mask' not in conds:
-                rr = 8
-                if area[2] != 0:
-                    for t in range(rr):
-                        mult[:,:,t:1+t,:] *= ((1.0/rr) * (t + 1))
-                if (area[0] + area[2]) < x_in.shape[2]:
-                    for t in range(rr):
-                        mult[:,:,area[0] - 1 - t:area[0] - t,:] *= ((1.0/rr) * (t + 1))
-                if area[3] != 0:
-                    for t in range(rr):
-                        mult[:,:,:,t:1+t] *= ((1.0/rr) * (t + 1))
-                if (area[1] + area[3]) < x_in.shape[3]:
-                    for t in range(rr):
-                        mult[:,:,:,area[1] - 1 - t:area[1] - t] *= ((1.0/rr) * (t + 1))
+                # broadcastable (1,1,H,W) feathered multiplier, cached for the run
+                mult = get_area_feather_mult(run_state, x_in, area, strength)
 
             conditionning = {}
             model_conds = conds["model_conds"]
@@ -325,30 +582,38 @@ def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_sc
 
             return out
 
-        def calc_cond_uncond_batch(model_function, cond, uncond, x_in, timestep, max_total_area, model_options):
-            out_cond = torch.zeros_like(x_in)
-            out_count = torch.ones_like(x_in)/100000.0
+        def calc_cond_uncond_batch(model_function, cond, uncond, x_in, timestep, max_total_area, model_options, workspace: 'WorkspacePool'=None):
+            if workspace is None:
+                out_cond = torch.zeros_like(x_in)
+                out_count = torch.ones_like(x_in)/100000.0
+
+                out_uncond = torch.zeros_like(x_in)
+                out_uncond_count = torch.ones_like(x_in)/100000.0
+            else:
+                # reuse buffers from workspace - outputs are consumed before the next call
+                out_cond = workspace.get_like("out_cond", x_in, 0.0)
+                out_count = workspace.get_like("out_count", x_in, 1.0/100000.0)
 
-            out_uncond = torch.zeros_like(x_in)
-            out_uncond_count = torch.ones_like(x_in)/100000.0
+                out_uncond = workspace.get_like("out_uncond", x_in, 0.0)
+                out_uncond_count = workspace.get_like("out_uncond_count", x_in, 1.0/100000.0)
 
             COND = 0
             UNCOND = 1
 
             to_run = []
-            for x in cond:
+            for i, x in enumerate(cond):
                 p = get_area_and_mult(x, x_in, timestep)
                 if p is None:
                     continue
 
-                to_run += [(p, COND)]
+                to_run += [(p, COND, i)]
             if uncond is not None:
-                for x in uncond:
+                for i, x in enumerate(uncond):
                     p = get_area_and_mult(x, x_in, timestep)
                     if p is None:
                         continue
 
-                    to_run += [(p, UNCOND)]
+                    to_run += [(p, UNCOND, i)]
 
             while len(to_run) > 0:
                 first = to_run[0]
@@ -371,6 +636,7 @@ def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_sc
                 mult = []
                 c = []
                 cond_or_uncond = []
+                cond_idxs = []
                 area = []
                 control = None
                 patches = None
@@ -382,6 +648,7 @@ def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_sc
                     c += [p[2]]
                     area += [p[3]]
                     cond_or_uncond += [o[1]]
+                    cond_idxs += [o[2]]
                     control = p[4]
                     patches = p[5]
 
@@ -409,6 +676,11 @@ def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_sc
                         transformer_options["patches"] = patches
 
                 transformer_options["cond_or_uncond"] = cond_or_uncond[:]
+                if run_state.motion_cache is not None:
+                    # residuals are stored per cond entry and latent frame, so they can be reused by any window covering those frames
+                    transformer_options[MOTION_CACHE_KEY] = MotionCacheCall(slots=list(zip(cond_or_uncond, cond_idxs)),
+                                                                            full_length=run_state.current_full_length or x_in.size(0),
+                                                                            frame_idxs=run_state.current_full_idxs)
                 c['transformer_options'] = transformer_options
 
                 if 'model_function_wrapper' in model_options:
@@ -436,26 +708,47 @@ def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_sc
         # sliding_calc_cond_uncond_batch inspired by ashen's initial hack for 16-frame sliding context:
         # https://github.com/comfyanonymous/ComfyUI/compare/master...ashen-sensored:ComfyUI:master
         def sliding_calc_cond_uncond_batch(model_function, cond, uncond, x_in, timestep, max_total_area, model_options):
-            # get context scheduler
-            context_scheduler = get_context_scheduler(ADGS.context_schedule)
             # figure out how input is split
-            axes_factor = x.size(0)//ADGS.video_length
+            axes_factor = x.size(0)//run_state.video_length
 
             # prepare final cond, uncond, and out_count
-            cond_final = torch.zeros_like(x)
-            uncond_final = torch.zeros_like(x)
-            out_count_final = torch.zeros((x.shape[0], 1, 1, 1), device=x.device)
+            cond_final = run_state.workspace.get("cond_final", x.shape, x.device, x.dtype, 0.0)
+            uncond_final = run_state.workspace.get("uncond_final", x.shape, x.device, x.dtype, 0.0)
+            out_count_final = run_state.workspace.get("out_count_final", (x.shape[0], 1, 1, 1), x.device, torch.float32, 0.0)
 
             def prepare_control_objects(control: ControlBase, full_idxs: list[int]):
                 if control.previous_controlnet is not None:
                     prepare_control_objects(control.previous_controlnet, full_idxs)
                 control.sub_idxs = full_idxs
-                control.full_latent_length = ADGS.video_length
-                control.context_length = ADGS.context_frames
+                control.full_latent_length = run_state.video_length
+                control.context_length = run_state.context_frames
             
-            def get_resized_cond(cond_in, full_idxs) -> list:
-                # reuse or resize cond items to match context requirements
+            def get_resized_cond(cond_in, full_idxs, window_key: tuple, cond_type: str) -> list:
+                # conds do not change during a sampling run, so reuse resized conds of recently run windows;
+                # entries keep cond_in alive and are checked by identity, so a new cond object never hits a stale entry
+                cache_key = (cond_type, axes_factor, window_key)
+                cached = run_state.resized_cond_cache.get(cache_key, None)
+                if cached is not None and cached[0] is cond_in:
+                    run_state.resized_cond_cache.move_to_end(cache_key)
+                    resized_cond = cached[1]
+                    # control objects still need to be told which idxs are in use
+                    for actual_cond in resized_cond:
+                        if actual_cond.get("control", None) is not None:
+                            prepare_control_objects(actual_cond["control"], full_idxs)
+                    return resized_cond
+                resized_cond, sliced = resize_cond(cond_in, full_idxs)
+                # when nothing was sliced, resized cond only holds references to the original tensors, so there is nothing to save
+                if sliced:
+                    run_state.resized_cond_cache[cache_key] = (cond_in, resized_cond)
+                    run_state.resized_cond_cache.move_to_end(cache_key)
+                    while len(run_state.resized_cond_cache) > RESIZED_COND_CACHE_SIZE:
+                        run_state.resized_cond_cache.popitem(last=False)
+                return resized_cond
+
+            def resize_cond(cond_in, full_idxs) -> tuple[list, bool]:
+                # reuse or resize cond items to match context requirements; also returns whether any tensor was sliced
                 resized_cond = []
+                sliced = False
                 # cond object is a list containing a dict - outer list is irrelevant, so just loop through it
                 for actual_cond in cond_in:
                     resized_actual_cond = actual_cond.copy()
@@ -469,6 +762,7 @@ def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_sc
                                     # if so, it's subsetting time - tell controls the expected indeces so they can handle them
                                     actual_cond_item = cond_item[full_idxs]
                                     resized_actual_cond[key] = actual_cond_item
+                                    sliced = True
                                 else:
                                     resized_actual_cond[key] = cond_item
                             # look for control
@@ -488,51 +782,88 @@ def sliding_sampling_function(model_function, x, timestep, uncond, cond, cond_sc
                                     if isinstance(cond_value, Tensor):
                                         if cond_value.size(0) == x.size(0):
                                             new_cond_item[cond_key] = cond_value[full_idxs]
+                                            sliced = True
                                     # if has cond that is a Tensor, check if needs to be subset
                                     elif hasattr(cond_value, "cond") and isinstance(cond_value.cond, Tensor):
                                         if cond_value.cond.size(0) == x.size(0):
                                             new_cond_item[cond_key] = cond_value._copy_with(cond_value.cond[full_idxs])
+                                            sliced = True
                                 resized_actual_cond[key] = new_cond_item
                             else:
                                 resized_actual_cond[key] = cond_item
                         finally:
                             del cond_item  # just in case to prevent VRAM issues
                     resized_cond.append(resized_actual_cond)
-                return resized_cond
-
-            # perform calc_cond_uncond_batch per context window
-            for ctx_idxs in context_scheduler(ADGS.current_step, ADGS.total_steps, ADGS.video_length, ADGS.context_frames, ADGS.context_stride, ADGS.context_overlap, ADGS.closed_loop):
+                return resized_cond, sliced
+
+            def get_window_groups(windows: list[ContextWindow]) -> list[list[ContextWindow]]:
+                # each window is run on its own unless window batching is enabled
+                if not run_state.batch_windows or run_state.sync_context_to_pe:
+                    return [[window] for window in windows]
+                # stack as many same-length windows as fit within the device's real batch area (not max_total_area,
+                # which unlimited_area_hack inflates), up to MAX_WINDOWS_PER_BATCH;
+                # cond and uncond can be batched together, so account for both
+                cond_count = (len(cond) if cond is not None else 0) + (len(uncond) if uncond is not None else 0)
+                window_area = axes_factor * run_state.context_frames * x.shape[2] * x.shape[3] * max(1, cond_count)
+                windows_per_batch = get_windows_per_batch(get_window_batch_area(), window_area)
+                groups = []
+                for window in windows:
+                    if len(groups) > 0 and len(groups[-1]) < windows_per_batch and len(groups[-1][0]) == len(window):
+                        groups[-1].append(window)
+                    else:
+                        groups.append([window])
+                return groups
+
+            def accumulate_window_group(window_group: list[ContextWindow], sub_cond_out: Tensor, sub_uncond_out: Tensor):
+                # accumulate each window separately, since overlapping windows may share idxs
+                offset = 0
+                for window in window_group:
+                    window_size = axes_factor * len(window)
+                    add_window_output(cond_final, window, axes_factor, run_state.video_length, sub_cond_out[offset:offset+window_size])
+                    add_window_output(uncond_final, window, axes_factor, run_state.video_length, sub_uncond_out[offset:offset+window_size])
+                    add_window_output(out_count_final, window, axes_factor, run_state.video_length, 1.0) # increment which indeces were used
+                    offset += window_size
+
+            # perform calc_cond_uncond_batch per group of context windows
+            for window_group in get_window_groups(run_state.context_plan.get_windows(run_state.current_step)):
                 # idxs of positional encoders in motion module to use, if needed (experimental, so disabled for now)
-                if ADGS.sync_context_to_pe:
-                    ADGS.sub_idxs = ctx_idxs
-                    ADGS.motion_module.set_sub_idxs(ADGS.sub_idxs)
-                # account for all portions of input frames
-                full_idxs = []
-                for n in range(axes_factor):
-                    for ind in ctx_idxs:
-                        full_idxs.append((ADGS.video_length*n)+ind)
+                if run_state.sync_context_to_pe:
+                    run_state.sub_idxs = window_group[0].idxs.tolist()
+                    run_state.motion_module.set_sub_idxs(run_state.sub_idxs)
+                # account for all portions of input frames; windows in a group are stacked along the batch,
+                # so each (b f) chunk of context_frames still belongs to a single window
+                full_idxs = [idx for window in window_group for idx in window.get_full_idxs(axes_factor, run_state.video_length)]
                 # get subsections of x, timestep, cond, uncond, cond_concat
-                sub_x = x[full_idxs]
-                sub_timestep = timestep[full_idxs]
-                sub_cond = get_resized_cond(cond, full_idxs) if cond is not None else None
-                sub_uncond = get_resized_cond(uncond, full_idxs) if uncond is not None else None
+                if len(window_group) == 1:
+                    sub_x = get_window_input(x, window_group[0], axes_factor, run_state.video_length)
+                    sub_timestep = get_window_input(timestep, window_group[0], axes_factor, run_state.video_length)
+                else:
+                    sub_x = torch.cat([get_window_input(x, window, axes_factor, run_state.video_length) for window in window_group])
+                    sub_timestep = torch.cat([get_window_input(timestep, window, axes_factor, run_state.video_length) for window in window_group])
+                window_key = tuple(window.key for window in window_group)
+                run_state.current_full_idxs = full_idxs
+                run_state.current_full_length = x.size(0)
+                sub_cond = get_resized_cond(cond, full_idxs, window_key, "cond") if cond is not None else None
+                sub_uncond = get_resized_cond(uncond, full_idxs, window_key, "uncond") if uncond is not None else None
 
-                sub_cond_out, sub_uncond_out = calc_cond_uncond_batch(model_function, sub_cond, sub_uncond, sub_x, sub_timestep, max_total_area, model_options)
+                sub_cond_out, sub_uncond_out = calc_cond_uncond_batch(model_function, sub_cond, sub_uncond, sub_x, sub_timestep, max_total_area, model_options, run_state.workspace)
 
-                cond_final[full_idxs] += sub_cond_out
-                uncond_final[full_idxs] += sub_uncond_out
-                out_count_final[full_idxs] += 1 # increment which indeces were used
+                accumulate_window_group(window_group, sub_cond_out, sub_uncond_out)
 
-            # normalize cond and uncond via division by context usage counts
-            cond_final /= out_count_final
-            uncond_final /= out_count_final
-            return cond_final, uncond_final
+            # normalize cond and uncond via division by context usage counts; results go into fresh tensors, since
+            # pooled accumulators get overwritten next step while the sampler may still hold on to what is returned
+            cond_out = cond_final / out_count_final
+            uncond_out = uncond_final / out_count_final
+            return cond_out, uncond_out
 
         max_total_area = model_management.maximum_batch_area()
+        run_state.update_motion_active()
+        if run_state.motion_cache is not None:
+            run_state.motion_cache.begin_sampling_call(run_state.current_step, timestep)
         if math.isclose(cond_scale, 1.0):
             uncond = None
 
-        if not ADGS.is_using_sliding_context():
+        if not run_state.is_using_sliding_context():
             cond, uncond = calc_cond_uncond_batch(model_function, cond, uncond, x, timestep, max_total_area, model_options)
         else:
             cond, uncond = sliding_calc_cond_uncond_batch(model_function, cond, uncond, x, timestep, max_total_area, model_options)
@@ -0,0 +1,68 @@
+"""
+Microbenchmark of context schedule generation: times generating every step's windows with the uniform, uniform_v2, and
+uniform_constant schedules, with and without precomputed ordered_halving offsets, and checks ordered_halving against
+the original string-formatting implementation. Only needs torch and numpy; ComfyUI is not required.
+"""
+import numpy as np
+
+from bench_utils import get_parser, load_standalone_module, time_function
+
+
+def ordered_halving_reference(val) -> float:
+    # original implementation: format as 64-bit binary string, reverse, and parse back
+    bin_str = f"{val:064b}"
+    bin_flip = bin_str[::-1]
+    as_int = int(bin_flip, 2)
+    return as_int / (1 << 64)
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--frames", type=int, nargs="+", default=[64, 256, 1024, 4096])
+    parser.add_argument("--context-length", type=int, default=16)
+    parser.add_argument("--context-stride", type=int, default=3)
+    parser.add_argument("--context-overlap", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    context = load_standalone_module("context")
+
+    # correctness of the bit-reversal paths
+    vals = list(range(5000)) + np.random.default_rng(0).integers(0, 2**63, size=5000, dtype=np.int64).tolist()
+    reference = [ordered_halving_reference(val) for val in vals]
+    context.ORDERED_HALVING_CACHE.clear()
+    if [context.ordered_halving(val) for val in vals] != reference or context.ordered_halving_array(vals).tolist() != reference:
+        raise SystemExit("FAILED: ordered_halving does not match the original implementation")
+    print(f"ordered_halving matches original implementation on {len(vals)} values")
+    print(f"ordered_halving x{len(vals)}: original {time_function(lambda: [ordered_halving_reference(v) for v in vals], args.repeats):.2f}ms, " +
+          f"table {time_function(lambda: [context.ordered_halving(v) for v in vals], args.repeats):.2f}ms, " +
+          f"array {time_function(lambda: context.ordered_halving_array(vals), args.repeats):.2f}ms")
+
+    schedules = [context.ContextSchedules.UNIFORM, context.ContextSchedules.UNIFORM_V2, context.ContextSchedules.UNIFORM_CONSTANT]
+    print(f"\nms to generate windows for all {args.steps} steps (context_length {args.context_length}, " +
+          f"stride {args.context_stride}, overlap {args.context_overlap})")
+    print(f"{'schedule':<18}{'frames':>8}{'windows':>10}{'cold':>10}{'precomputed':>14}")
+    for schedule in schedules:
+        scheduler = context.get_context_scheduler(schedule)
+        for frames in args.frames:
+            def generate():
+                return sum(len(list(scheduler(step, args.steps, frames, args.context_length, args.context_stride,
+                                              args.context_overlap, False))) for step in range(args.steps))
+
+            def generate_cold():
+                context.ORDERED_HALVING_CACHE.clear()
+                return generate()
+
+            def generate_precomputed():
+                context.precompute_ordered_halving(args.steps)
+                return generate()
+
+            windows = generate_cold()
+            cold_ms = time_function(generate_cold, args.repeats)
+            precomputed_ms = time_function(generate_precomputed, args.repeats)
+            print(f"{schedule:<18}{frames:>8}{windows:>10}{cold_ms:>10.2f}{precomputed_ms:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
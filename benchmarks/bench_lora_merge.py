@@ -0,0 +1,94 @@
+"""
+Benchmark of motion LoRA delta merging for 1, 3, and 5 stacked LoRAs, using synthetic v2-layout LoRAs. Compares the previous
+per-key loop (string key mapping + one torch.mm per layer, every time) against MotionLoRAWrapper's cached key map with
+batched bmm, both on first use and with cached deltas (e.g. after a strength change). Only needs torch; ComfyUI is not required.
+"""
+import torch
+
+from bench_utils import get_parser, load_standalone_module, time_function
+
+# (block prefix, amount of motion modules, channels) of a v2 AnimateDiff motion model
+V2_BLOCKS = [(f"down_blocks.{i}", 2, c) for i, c in enumerate([320, 640, 1280, 1280])] + \
+    [(f"up_blocks.{i}", 3, c) for i, c in enumerate([1280, 1280, 640, 320])] + [("mid_block", 1, 1280)]
+
+
+def make_lora_state_dict(rank: int, device: torch.device, dtype: torch.dtype, generator: torch.Generator) -> dict[str, torch.Tensor]:
+    state_dict = {}
+    for prefix, module_count, channels in V2_BLOCKS:
+        for m in range(module_count):
+            for a in range(2):
+                for proj in ["to_q", "to_k", "to_v", "to_out"]:
+                    key = f"{prefix}.motion_modules.{m}.temporal_transformer.transformer_blocks.0.attention_blocks.{a}.processor.{proj}_lora"
+                    state_dict[f"{key}.down.weight"] = torch.randn((rank, channels), generator=generator).to(device=device, dtype=dtype)
+                    state_dict[f"{key}.up.weight"] = torch.randn((channels, rank), generator=generator).to(device=device, dtype=dtype) * 0.01
+    return state_dict
+
+
+def merge_previous(state_dicts: list[dict[str, torch.Tensor]], strengths: list[float]) -> dict[str, torch.Tensor]:
+    # previous implementation: key string surgery and a torch.mm per layer, for every LoRA on every load
+    summed = {}
+    for state_dict, strength in zip(state_dicts, strengths):
+        for key in state_dict:
+            if "up." in key: continue
+            up_key = key.replace(".down.", ".up.")
+            model_key = key.replace("processor.", "").replace("_lora", "").replace("down.", "").replace("up.", "")
+            model_key = model_key.replace("to_out.", "to_out.0.")
+            delta = strength * torch.mm(state_dict[up_key], state_dict[key]).float()
+            if model_key in summed:
+                summed[model_key] += delta
+            else:
+                summed[model_key] = delta
+    return summed
+
+
+def merge_current(loras: list, strengths: list[float]) -> dict[str, torch.Tensor]:
+    # same summation as apply_motion_loras, using deltas cached on the LoRA wrappers
+    summed = {}
+    for lora, strength in zip(loras, strengths):
+        for model_key, delta in lora.get_deltas(include_midblock=True).items():
+            if model_key in summed:
+                summed[model_key].add_(delta, alpha=strength)
+            else:
+                summed[model_key] = delta.float() * strength
+    return summed
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--rank", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    motion_lora = load_standalone_module("motion_lora")
+    device = torch.device("cpu" if args.cpu or not torch.cuda.is_available() else "cuda")
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    synchronize = torch.cuda.synchronize if device.type == "cuda" else None
+    generator = torch.Generator(device="cpu").manual_seed(0)
+    state_dicts = [make_lora_state_dict(args.rank, device, dtype, generator) for _ in range(max(args.counts))]
+
+    print(f"device: {device}, dtype: {dtype}, rank: {args.rank}, layers per LoRA: {len(state_dicts[0]) // 2}")
+    print(f"{'LoRAs':>6}{'previous':>12}{'first use':>12}{'cached':>12}{'max diff':>12}")
+    for count in args.counts:
+        strengths = [1.0 - 0.1 * i for i in range(count)]
+        previous_ms = time_function(lambda: merge_previous(state_dicts[:count], strengths), args.repeats, synchronize=synchronize)
+
+        def merge_first_use():
+            loras = [motion_lora.MotionLoRAWrapper(state_dict, str(i)) for i, state_dict in enumerate(state_dicts[:count])]
+            return merge_current(loras, strengths)
+        first_use_ms = time_function(merge_first_use, args.repeats, synchronize=synchronize)
+
+        loras = [motion_lora.MotionLoRAWrapper(state_dict, str(i)) for i, state_dict in enumerate(state_dicts[:count])]
+        merge_current(loras, strengths)
+        # a strength change only rescales cached deltas
+        new_strengths = [s * 0.5 for s in strengths]
+        cached_ms = time_function(lambda: merge_current(loras, new_strengths), args.repeats, synchronize=synchronize)
+
+        reference = merge_previous(state_dicts[:count], new_strengths)
+        current = merge_current(loras, new_strengths)
+        max_diff = max((reference[key] - current[key]).abs().max().item() for key in reference)
+        print(f"{count:>6}{previous_ms:>10.1f}ms{first_use_ms:>10.1f}ms{cached_ms:>10.1f}ms{max_diff:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Benchmark of step-range gating of motion modules: samples the same animation with motion modules running for all steps,
+and with them bypassed after end_percent of steps, and reports the speedup. Uses real models through ComfyUI's nodes,
+so a checkpoint and a motion model need to be installed.
+"""
+import torch
+
+from bench_utils import get_parser, import_ade_module, time_function
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.add_argument("--checkpoint", type=str, required=True, help="SD1.5 checkpoint name, as listed in ComfyUI")
+    parser.add_argument("--motion-model", type=str, required=True, help="motion model name, e.g. mm_sd_v15_v2.ckpt")
+    parser.add_argument("--end-percents", type=float, nargs="+", default=[0.6, 0.3])
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    ade_nodes = import_ade_module("nodes", args)
+    model_utils = import_ade_module("model_utils", args)
+    import comfy.model_management as model_management
+    import nodes as comfy_nodes
+
+    model, clip, _ = comfy_nodes.CheckpointLoaderSimple().load_checkpoint(args.checkpoint)[:3]
+    positive = comfy_nodes.CLIPTextEncode().encode(clip, "a boat sailing on the ocean, waves, sunset")[0]
+    negative = comfy_nodes.CLIPTextEncode().encode(clip, "blurry, low quality")[0]
+    latent = comfy_nodes.EmptyLatentImage().generate(args.size, args.size, batch_size=args.frames)[0]
+    device = model_management.get_torch_device()
+    synchronize = torch.cuda.synchronize if device.type == "cuda" else None
+
+    def run(end_percent: float):
+        ad_model = ade_nodes.AnimateDiffLoaderWithContext().load_mm_and_inject_params(
+            model, args.motion_model, model_utils.BetaSchedules.SQRT_LINEAR, end_percent=end_percent)[0]
+        return comfy_nodes.KSampler().sample(ad_model, 0, args.steps, 7.5, "euler", "normal", positive, negative, latent)
+
+    print(f"device: {device}, frames: {args.frames}, size: {args.size}x{args.size}, steps: {args.steps}")
+    full_ms = time_function(lambda: run(1.0), args.repeats, synchronize=synchronize)
+    print(f"end_percent 1.0 (full run): {full_ms:.0f}ms")
+    for end_percent in args.end_percents:
+        gated_ms = time_function(lambda: run(end_percent), args.repeats, synchronize=synchronize)
+        print(f"end_percent {end_percent}: {gated_ms:.0f}ms ({full_ms / max(gated_ms, 1e-9):.2f}x speedup)")
+
+
+if __name__ == "__main__":
+    main()
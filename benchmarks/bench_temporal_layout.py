@@ -0,0 +1,92 @@
+"""
+Benchmark of the temporal-major layout of AnimateDiff temporal transformers. Compares the current forward, which switches
+to (b h w) f c once on entry and back once on exit, against a reference of the previous layout, which rearranged
+(b f) d c <-> (b d) f c around every attention block. Checks that outputs match, and reports the activation bytes no longer
+moved by transposes (per module measured, and estimated for a full SD1.5 UNet call) at 512x512 and 1024x1024.
+"""
+import torch
+
+from bench_utils import get_parser, import_ade_module, time_function
+
+# SD1.5 UNet levels that have motion modules: (channels, latent downscale, modules in down blocks + mid + up blocks)
+SD15_MOTION_LEVELS = [
+    (320, 1, 2 + 3),
+    (640, 2, 2 + 3),
+    (1280, 4, 2 + 3),
+    (1280, 8, 2 + 1 + 3),
+]
+# transposes of full activations removed per temporal module: into and out of temporal-major, for each of 2 attention blocks
+REMOVED_TRANSPOSES = 4
+
+
+def legacy_forward(transformer, hidden_states: torch.Tensor) -> torch.Tensor:
+    # reference of TemporalTransformer3DModel.forward with the previous layout: token-major (b f) d c between blocks,
+    # with a rearrange to temporal-major (b d) f c and back around each attention block
+    batch, channel, height, width = hidden_states.shape
+    video_length = transformer.video_length
+    residual = hidden_states
+    hidden_states = transformer.norm(hidden_states)
+    hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(batch, height * width, channel)
+    hidden_states = transformer.proj_in(hidden_states)
+    inner_dim = hidden_states.shape[-1]
+    for block in transformer.transformer_blocks:
+        for attention_block, norm in zip(block.attention_blocks, block.norms):
+            norm_hidden_states = norm(hidden_states)
+            d = norm_hidden_states.shape[1]
+            # (b f) d c -> (b d) f c
+            norm_hidden_states = norm_hidden_states.reshape(-1, video_length, d, inner_dim).permute(0, 2, 1, 3).reshape(-1, video_length, inner_dim)
+            attn_out = attention_block(norm_hidden_states, video_length=video_length)
+            # (b d) f c -> (b f) d c
+            attn_out = attn_out.reshape(-1, d, video_length, inner_dim).permute(0, 2, 1, 3).reshape(-1, d, inner_dim)
+            hidden_states = attn_out + hidden_states
+        hidden_states = block.ff(block.ff_norm(hidden_states)) + hidden_states
+    hidden_states = transformer.proj_out(hidden_states)
+    hidden_states = hidden_states.reshape(batch, height, width, inner_dim).permute(0, 3, 1, 2).contiguous()
+    return hidden_states + residual
+
+
+def main():
+    parser = get_parser(__doc__)
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=2, help="videos per call, e.g. 2 for cond + uncond")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[512, 1024])
+    parser.add_argument("--channels", type=int, default=320, help="channels of the measured temporal module")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    motion_module_ad = import_ade_module("motion_module_ad", args)
+    import comfy.model_management as model_management
+
+    device = model_management.get_torch_device()
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    element_size = torch.empty((), dtype=dtype).element_size()
+    synchronize = torch.cuda.synchronize if device.type == "cuda" else None
+
+    torch.manual_seed(0)
+    module = motion_module_ad.VanillaTemporalModule(in_channels=args.channels, zero_initialize=False).to(device=device, dtype=dtype)
+    module.set_video_length(args.frames)
+    transformer = module.temporal_transformer
+
+    print(f"device: {device}, dtype: {dtype}, frames: {args.frames}, videos per call: {args.batch}")
+    for resolution in args.resolutions:
+        latent = resolution // 8
+        x = torch.randn((args.batch * args.frames, args.channels, latent, latent), device=device, dtype=dtype)
+        with torch.no_grad():
+            current = module(x)
+            reference = legacy_forward(transformer, x)
+            max_diff = (current.float() - reference.float()).abs().max().item()
+            current_ms = time_function(lambda: module(x), args.repeats, synchronize=synchronize)
+            legacy_ms = time_function(lambda: legacy_forward(transformer, x), args.repeats, synchronize=synchronize)
+        # each transpose reads and writes the whole activation
+        module_bytes = REMOVED_TRANSPOSES * 2 * x.numel() * element_size
+        unet_bytes = sum(count * REMOVED_TRANSPOSES * 2 * args.batch * args.frames * channels * (latent // downscale) ** 2 * element_size
+                         for channels, downscale, count in SD15_MOTION_LEVELS)
+        print(f"\n{resolution}x{resolution} ({args.channels} channels, {latent}x{latent} latent)")
+        print(f"  max abs difference vs previous layout: {max_diff:.3e}")
+        print(f"  previous layout: {legacy_ms:.2f}ms, temporal-major: {current_ms:.2f}ms ({legacy_ms / max(current_ms, 1e-9):.2f}x)")
+        print(f"  transpose traffic removed: {module_bytes / 2**20:.1f} MiB for this module, " +
+              f"~{unet_bytes / 2**20:.1f} MiB per SD1.5 UNet call (v2 motion model)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Shared helpers for the standalone scripts in this folder. Scripts are run directly, e.g.:
+#   python custom_nodes/ComfyUI-AnimateDiff-Evolved/benchmarks/bench_context.py
+# Modules that depend on ComfyUI are imported as part of this custom node package, so ComfyUI must be
+# installed at the usual location (this repo inside ComfyUI/custom_nodes), or be passed in with --comfyui-path.
+import argparse
+import importlib
+import importlib.util
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import ModuleType
+from typing import Callable
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def get_parser(description: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--comfyui-path", type=str, default=str(REPO_DIR.parent.parent),
+                        help="path to the ComfyUI folder this repo is installed in")
+    parser.add_argument("--cpu", action="store_true", help="run ComfyUI with the CPU as its torch device")
+    return parser
+
+
+def import_ade_module(name: str, args: argparse.Namespace) -> ModuleType:
+    # comfy parses sys.argv on import, so hand it only the flags meant for it
+    sys.argv = [sys.argv[0]] + (["--cpu"] if args.cpu else [])
+    for path in (args.comfyui_path, str(REPO_DIR.parent)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    return importlib.import_module(f"{REPO_DIR.name}.animatediff.{name}")
+
+
+def load_standalone_module(name: str) -> ModuleType:
+    # for modules without ComfyUI or relative imports (e.g. context.py, motion_lora.py), so no ComfyUI is needed
+    spec = importlib.util.spec_from_file_location(f"ade_{name}", REPO_DIR / "animatediff" / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def time_function(func: Callable, repeats: int=5, warmup: int=1, synchronize: Callable=None) -> float:
+    # returns median wall time in ms
+    for _ in range(warmup):
+        func()
+    if synchronize is not None:
+        synchronize()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        if synchronize is not None:
+            synchronize()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)